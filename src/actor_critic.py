@@ -1,7 +1,18 @@
 # import ollama
-from openai import OpenAI
-from dataclasses import dataclass
+import os
+import re
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+from dataclasses import dataclass, field
 from .promptscenario import scenario_prompt
+from .llmcache import CompletionCache
+from .httpclient import get_openai_client, LLM_READ_TIMEOUT
+from .resilience import get_breaker, get_retry_policy, is_retryable_openai, retry_after_of
+from .ratelimit import LLMScheduler, get_llm_scheduler
+from .textprep import fit_to_budget
 # LLM_MODEL = 'llama3:8b' 
 
 
@@ -9,30 +20,97 @@ from .promptscenario import scenario_prompt
 class GenerationConfig:
     """Конфигурация для генерации"""
     max_iterations: int = 5
-    max_length: int = 2048
+    max_length: int = 2048  # max_tokens ответа актора (сценария)
     actor_temperature: float = 1.2  # Высокая температура для креативности
     critic_temperature: float = 0.3  # Низкая температура для точности
+    actor_model: Optional[str] = None  # None — LLM_MODEL
+    critic_model: Optional[str] = None  # Критику хватает модели попроще и побыстрее; None — LLM_MODEL
+    critic_max_tokens: int = 700  # Короткий ответ критика заметно сокращает каждую итерацию
+    summary_model: Optional[str] = None  # Модель для map-reduce суммаризации; None — LLM_MODEL
+    summary_temperature: float = 0.3
+    summary_max_tokens: int = 1500
+    repair_model: Optional[str] = None  # Модель для точечных дозапросов починки сценария; None — LLM_MODEL
+    repair_temperature: float = 0.3
+    repair_max_tokens: int = 400  # Ответ — одно описание персонажа или сцены
     min_comic_length: int = 0  # Минимальная длина комикса
+    use_cache: bool = True  # False — не читать кэш ответов (свежая генерация), но результат всё равно сохраняется
+    long_document_threshold: int = 24000  # Документ длиннее (в символах) сначала сжимается map-reduce суммаризацией
+    chunk_size: int = 8000  # Размер куска документа для суммаризации (в символах)
+    summary_workers: int = 4  # Сколько кусков суммаризируем параллельно
+    accept_score: int = 8  # Оценка критика (из 10), при которой дальнейшие доработки не нужны
+    time_budget: Optional[float] = None  # Бюджет времени (сек) на весь цикл актор-критик; None — без ограничения
+
+
+@dataclass
+class CriticVerdict:
+    """Машиночитаемый итог ответа критика."""
+    score: Optional[int] = None
+    accept: bool = False
+
+
+@dataclass
+class LoopStats:
+    """Как прошёл последний actor_critic_loop: сколько итераций и почему остановились."""
+    iterations: int = 0
+    llm_calls: int = 0
+    stop_reason: str = ""  # accepted | max_iterations | time_budget
+    scores: list = field(default_factory=list)
+    elapsed: float = 0.0
+
+
+_SCORE_RE = re.compile(r"\[score\]\s*(\d+)(?:\s*/\s*10)?\s*\[endscore\]", re.IGNORECASE)
+_VERDICT_RE = re.compile(r"\[verdict\]\s*(\w+)\s*\[endverdict\]", re.IGNORECASE)
+
+
+def parse_critic_verdict(text: str) -> CriticVerdict:
+    """Достаёт [score]N[endscore] и [verdict]ACCEPT|REVISE[endverdict] из ответа критика (берётся последнее вхождение)."""
+    verdict = CriticVerdict()
+    scores = _SCORE_RE.findall(text or "")
+    if scores:
+        verdict.score = max(0, min(10, int(scores[-1])))
+    verdicts = _VERDICT_RE.findall(text or "")
+    if verdicts:
+        verdict.accept = verdicts[-1].upper() == "ACCEPT"
+    return verdict
+
+
+LLM_MODEL = "deepseek/deepseek-chat-v3.1:free"
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_completion_cache() -> Optional[CompletionCache]:
+    """Общий на процесс кэш ответов LLM (None, если отключён через COMIX_LLM_CACHE=0)."""
+    global _default_cache
+    if os.getenv("COMIX_LLM_CACHE", "1") == "0":
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = CompletionCache(
+                max_entries=int(os.getenv("COMIX_LLM_CACHE_SIZE", "256")),
+                # Дисковый уровень включается только явно указанным путём к SQLite
+                sqlite_path=os.getenv("COMIX_LLM_CACHE_PATH") or None,
+                ttl=float(os.getenv("COMIX_LLM_CACHE_TTL", "0")),
+            )
+    return _default_cache
 
 
 class ComicGenerationSystem:
-    def __init__(self, config: GenerationConfig):
+    def __init__(self, config: GenerationConfig, cache: Optional[CompletionCache] = None, client=None,
+                 scheduler: Optional[LLMScheduler] = None):
         self.config = config
-        import os
-        try:
-            from dotenv import load_dotenv, find_dotenv
-            load_dotenv(find_dotenv())
-        except Exception:
-            pass
-
-        api_key = os.getenv("OPENROUTER_API_KEY")
-        if not api_key:
-            raise RuntimeError("OPENROUTER_API_KEY не найден в окружении/.env")
-
-        self.client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=api_key,
-        )
+        self.cache = cache if cache is not None else get_completion_cache()
+        # Клиент OpenRouter общий на процесс: keep-alive соединения переживают отдельные комиксы
+        self.client = client if client is not None else get_openai_client()
+        # Повторы 429/5xx/обрывов с джиттером в пределах крайнего срока задачи; при лежащем OpenRouter — быстрый отказ
+        self.retry = get_retry_policy("openrouter", attempts=3, base_delay=2.0, max_delay=20.0,
+                                      timeout=LLM_READ_TIMEOUT, retryable=is_retryable_openai)
+        self.breaker = get_breaker("openrouter")
+        # Общий ключ OpenRouter: лимиты RPM/параллельности и очередь между комиксами — одни на процесс
+        self.scheduler = scheduler if scheduler is not None else get_llm_scheduler()
+        # Экземпляр может обслуживать несколько комиксов параллельно — статистика своя у каждого потока
+        self._local = threading.local()
 
         # Рекомендуемые заголовки OpenRouter (для трекинга приложения)
         self._extra_headers = {
@@ -54,11 +132,24 @@ class ComicGenerationSystem:
                         7. Проверь, что если чего-то нет на изображении, то даже упоминания этого нет в тексте. (например фраза "машина уехала" - нельзя, т.к. машины нет в кадре. "Дождь закончился" - нельзя, диффузионка нарисует дождь, поскольку увидит это слово. Очень внимательно проверь текст насчет этого!)
                         Ни в коем случае не трогай никакие теги (весь текст в квадратных скобках, такой как [placeholder])
                         совсем не трогай. Они нужны для парсинга. Даже если тебе кажется, что они неправильные, не трогай их.
+                        Пиши кратко: только самые важные замечания коротким списком, без пересказа комикса.
+                        В самом конце ответа обязательно поставь итоговую оценку строго в таком формате:
+                        [score]N[endscore] — где N целое число от 1 до 10,
+                        [verdict]ACCEPT[endverdict] — если комикс можно отдавать без правок, иначе [verdict]REVISE[endverdict].
                         Комикс:
                         {comic}
                     """
         )
 
+        self.summary_prompt_template = (
+            """Ниже часть {part} из {total} большого документа. Кратко перескажи её на русском языке:
+                        сохрани все ключевые правила, требования, сроки, числа, адреса и порядок действий,
+                        убери повторы и формальности. Не добавляй ничего от себя, без вступлений и выводов.
+                        Часть документа:
+                        {chunk}
+                    """
+        )
+
         self.improvement_prompt = (
             """
                         Предыдущий комикс:
@@ -71,6 +162,15 @@ class ComicGenerationSystem:
                     """
         )
 
+    @property
+    def last_run(self) -> Optional[LoopStats]:
+        """Статистика последнего actor_critic_loop в текущем потоке."""
+        return getattr(self._local, 'last_run', None)
+
+    @last_run.setter
+    def last_run(self, stats: Optional[LoopStats]) -> None:
+        self._local.last_run = stats
+
     # LLM_MODEL = 'llama3:8b' 
 
 
@@ -83,26 +183,220 @@ class ComicGenerationSystem:
     #     return response['message']['content']
 
 
-    def generate_text(self, promt):
-        completion = self.client.chat.completions.create(
-            extra_headers=self._extra_headers,
-            extra_body={},
-            model="deepseek/deepseek-chat-v3.1:free",
+    def _create(self, timeout, hold_slot: bool = False, **kwargs):
+        """
+        Один запрос к OpenRouter через планировщик (очередь, RPM, параллельность).
+
+        При 429 планировщик приостанавливает выдачу слотов на Retry-After для всех задач.
+        hold_slot=True — слот не освобождается (для стрима; освобождает вызывающий).
+        """
+        self.scheduler.acquire()
+        try:
+            result = self.client.chat.completions.create(
+                extra_headers=self._extra_headers,
+                extra_body={},
+                timeout=timeout,
+                **kwargs
+            )
+        except Exception as e:
+            self.scheduler.release()
+            if getattr(e, 'status_code', None) == 429:
+                self.scheduler.penalize(retry_after_of(e))
+            raise
+        if not hold_slot:
+            self.scheduler.release()
+        return result
+
+    def role_settings(self, role: str) -> tuple[str, dict]:
+        """Модель и параметры сэмплинга для роли: actor (сценарий), critic (оценка), summary (выжимка), repair (дозапрос)."""
+        config = self.config
+        if role == "actor":
+            model, temperature, max_tokens = config.actor_model, config.actor_temperature, config.max_length
+        elif role == "critic":
+            model, temperature, max_tokens = config.critic_model, config.critic_temperature, config.critic_max_tokens
+        elif role == "summary":
+            model, temperature, max_tokens = config.summary_model, config.summary_temperature, config.summary_max_tokens
+        elif role == "repair":
+            model, temperature, max_tokens = config.repair_model, config.repair_temperature, config.repair_max_tokens
+        else:
+            raise ValueError(f"Неизвестная роль: {role!r}")
+        params = {}
+        if temperature is not None:
+            params["temperature"] = temperature
+        if max_tokens:
+            params["max_tokens"] = max_tokens
+        return model or LLM_MODEL, params
+
+    def generate_text(self, promt, use_cache: Optional[bool] = None, role: str = "actor"):
+        # Параметры сэмплинга входят в ключ кэша вместе с моделью и промптом
+        model, params = self.role_settings(role)
+        if use_cache is None:
+            use_cache = self.config.use_cache
+
+        key = None
+        if self.cache is not None:
+            key = CompletionCache.key(model, promt, params)
+            if use_cache:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    return cached
+
+        completion = self.retry.call(lambda timeout: self._create(
+            timeout,
+            model=model,
             messages=[
                 {
                     "role": "user",
                     "content":  promt
                 }
-            ]
-        )
-        return completion.choices[0].message.content
+            ],
+            **params
+        ), breaker=self.breaker)
+        text = completion.choices[0].message.content
 
+        if key is not None and text:
+            usage = getattr(completion, 'usage', None)
+            self.cache.put(key, text, getattr(usage, 'total_tokens', 0) or 0)
+        return text
+
+
+    def generate_text_stream(self, promt, use_cache: Optional[bool] = None, role: str = "actor") -> Iterator[str]:
+        """Как generate_text, но отдаёт ответ кусками по мере генерации (при попадании в кэш — одним куском)."""
+        model, params = self.role_settings(role)
+        if use_cache is None:
+            use_cache = self.config.use_cache
+
+        key = None
+        if self.cache is not None:
+            key = CompletionCache.key(model, promt, params)
+            if use_cache:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    yield cached
+                    return
+
+        # Повторяется только открытие потока: после первых кусков ответ уже ушёл дальше по конвейеру
+        # Слот планировщика держится, пока поток не дочитан
+        stream = self.retry.call(lambda timeout: self._create(
+            timeout,
+            hold_slot=True,
+            model=model,
+            messages=[
+                {
+                    "role": "user",
+                    "content":  promt
+                }
+            ],
+            stream=True,
+            stream_options={"include_usage": True},
+            **params
+        ), breaker=self.breaker)
+        parts = []
+        tokens = 0
+        try:
+            for chunk in stream:
+                usage = getattr(chunk, 'usage', None)
+                if usage is not None:
+                    tokens = getattr(usage, 'total_tokens', 0) or 0
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        finally:
+            self.scheduler.release()
+
+        text = "".join(parts)
+        if key is not None and text:
+            self.cache.put(key, text, tokens)
+
+
+    def split_into_chunks(self, document: str) -> list[str]:
+        """Режет документ на куски не длиннее chunk_size, по возможности по границам абзацев."""
+        size = self.config.chunk_size
+        chunks = []
+        current = ""
+        for paragraph in document.split("\n"):
+            while len(paragraph) > size:
+                # абзац сам длиннее куска — режем его по последнему пробелу
+                cut = paragraph.rfind(" ", 0, size)
+                cut = cut if cut > 0 else size
+                if current:
+                    chunks.append(current)
+                    current = ""
+                chunks.append(paragraph[:cut])
+                paragraph = paragraph[cut:].lstrip()
+            if current and len(current) + len(paragraph) + 1 > size:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n{paragraph}" if current else paragraph
+        if current.strip():
+            chunks.append(current)
+        return chunks
+
+    def reduce_document(self, document: str) -> str:
+        """
+        Map-reduce для длинных документов: куски суммаризируются параллельно,
+        а в сценарный промпт уходит склеенная выжимка. Короткие документы не трогаем.
+        """
+        # Повторяем, пока выжимка не влезет в порог (но не бесконечно, если модель не сжимает)
+        for _round in range(3):
+            if len(document) <= self.config.long_document_threshold:
+                break
+            chunks = self.split_into_chunks(document)
+            prompts = [
+                self.summary_prompt_template.format(part=i + 1, total=len(chunks), chunk=chunk)
+                for i, chunk in enumerate(chunks)
+            ]
+            workers = max(1, min(self.config.summary_workers, len(prompts)))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="summary") as pool:
+                # copy_context: крайний срок задачи (resilience.deadline_scope) действует и в потоках пула
+                futures = [
+                    pool.submit(contextvars.copy_context().run, self.generate_text, p, role="summary")
+                    for p in prompts
+                ]
+                summaries = [f.result() for f in futures]
+            reduced = "\n\n".join(summary.strip() for summary in summaries if summary)
+            print(f"======SUMMARY====== {len(document)} -> {len(reduced)} символов, {len(chunks)} кусков")
+            if not reduced or len(reduced) >= len(document):
+                break
+            document = reduced
+        return document
 
     def actor_critic_loop(self, document: str):        
+        return "".join(self.iter_actor_critic(document))
+
+    def iter_actor_critic(self, document: str) -> Iterator[str]:
+        """
+        Цикл актор-критик, отдающий итоговый сценарий кусками.
+
+        Черновик, который заведомо последний (итерация max_iterations - 1), стримится
+        по мере генерации, чтобы следующие этапы начали работу раньше. Если цикл
+        остановился раньше (критик принял черновик, кончился бюджет времени),
+        готовый сценарий отдаётся одним куском.
+        """
+        started = time.monotonic()
+        deadline = started + self.config.time_budget if self.config.time_budget else None
+        stats = LoopStats()
+        self.last_run = stats
+
+        document = self.reduce_document(document)
+        # Бюджет токенов (COMIX_TOKEN_BUDGET) — на то, что уходит актору: длинный документ режем
+        # только после суммаризации, иначе его хвост не попал бы даже в выжимку
+        document, truncated = fit_to_budget(document)
+        if truncated:
+            print(f"======BUDGET====== документ обрезан до {len(document)} символов")
         current_comic = ""
-        critic_prompt = ""
+        critic_response = ""
+        actor_seconds = 0.0
+        streamed = False
         for iteration in range(self.config.max_iterations):
-            
+            # Не начинаем доработку, если она заведомо не уложится в бюджет времени
+            if iteration > 0 and deadline is not None and time.monotonic() + actor_seconds > deadline:
+                stats.stop_reason = "time_budget"
+                break
+
             if iteration == 0:
                 actor_prompt = self.actor_prompt_template.format(document=document)
             else:
@@ -110,31 +404,89 @@ class ComicGenerationSystem:
                     critic_feedback=critic_response)
             
             #* gen by actor
-            current_comic = self.generate_text(actor_prompt)
+            actor_started = time.monotonic()
+            if iteration == self.config.max_iterations - 1:
+                parts = []
+                for delta in self.generate_text_stream(actor_prompt):
+                    parts.append(delta)
+                    yield delta
+                current_comic = "".join(parts)
+                streamed = True
+            else:
+                current_comic = self.generate_text(actor_prompt)
+            actor_seconds = time.monotonic() - actor_started
+            stats.iterations += 1
+            stats.llm_calls += 1
             print("======ACTOR======")
             print(current_comic)
             print()
                         
             #* reword by critic
-            if iteration != self.config.max_iterations - 1:
-                critic_prompt = self.critic_prompt_template.format(comic=current_comic)
-                critic_response = self.generate_text(critic_prompt)
-                print("======CRITIC======")
-                print(critic_response)
-                print()
-
-        return current_comic
+            if iteration == self.config.max_iterations - 1:
+                stats.stop_reason = "max_iterations"
+                break
+            if deadline is not None and time.monotonic() > deadline:
+                stats.stop_reason = "time_budget"
+                break
+
+            critic_prompt = self.critic_prompt_template.format(comic=current_comic)
+            critic_response = self.generate_text(critic_prompt, role="critic")
+            stats.llm_calls += 1
+            print("======CRITIC======")
+            print(critic_response)
+            print()
+
+            verdict = parse_critic_verdict(critic_response)
+            stats.scores.append(verdict.score)
+            if verdict.accept or (verdict.score is not None and verdict.score >= self.config.accept_score):
+                stats.stop_reason = "accepted"
+                break
+
+        stats.elapsed = time.monotonic() - started
+        print(f"======LOOP====== итераций: {stats.iterations}, вызовов LLM: {stats.llm_calls}, "
+              f"остановка: {stats.stop_reason}, оценки: {stats.scores}, {stats.elapsed:.1f} с")
+        if not streamed:
+            yield current_comic
             
     
-def generate_comix_actcrit(document):
-    config = GenerationConfig(
+def _default_config() -> GenerationConfig:
+    return GenerationConfig(
         max_iterations=2,
         actor_temperature=1.2,
         critic_temperature=0.3,
-        min_comic_length=300
+        min_comic_length=300,
+        max_length=int(os.getenv("COMIX_ACTOR_MAX_TOKENS", "4096")),
+        actor_model=os.getenv("COMIX_ACTOR_MODEL") or None,
+        critic_model=os.getenv("COMIX_CRITIC_MODEL") or None,
+        critic_max_tokens=int(os.getenv("COMIX_CRITIC_MAX_TOKENS", "700")),
+        summary_model=os.getenv("COMIX_SUMMARY_MODEL") or None,
+        repair_model=os.getenv("COMIX_REPAIR_MODEL") or None,
+        time_budget=float(os.getenv("COMIX_TEXT_TIME_BUDGET", "0")) or None,
     )
-    
-    system = ComicGenerationSystem(config)
+
+
+_default_system = None
+_default_system_lock = threading.Lock()
+
+
+def get_comic_system() -> ComicGenerationSystem:
+    """Общий на процесс ComicGenerationSystem с конфигурацией по умолчанию (создаётся при первом вызове)."""
+    global _default_system
+    with _default_system_lock:
+        if _default_system is None:
+            _default_system = ComicGenerationSystem(_default_config())
+    return _default_system
+
+
+def generate_comix_actcrit(document):
+    system = get_comic_system()
     
     return system.actor_critic_loop(document)
 
+
+def generate_comix_actcrit_stream(document) -> Iterator[str]:
+    """Потоковый вариант generate_comix_actcrit: отдаёт итоговый сценарий кусками."""
+    system = get_comic_system()
+    return system.iter_actor_critic(document)
+
+
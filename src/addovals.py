@@ -2,8 +2,20 @@ from __future__ import annotations
 
 import math
 import io
-from PIL import Image, ImageDraw, ImageFont
-import textwrap
+from PIL import Image, ImageDraw
+
+from .textlayout import TextLayout, TextLayoutEngine
+
+# Style parameters
+BORDER_COLOR = "black"
+FILL_COLOR = "white"
+BORDER_WIDTH = 3
+TEXT_COLOR = "black"
+
+# Минимальный зазор между соседними пузырями при совместной раскладке
+BUBBLE_GAP = 10
+
+
 def add_speech_bubble(
     image_bytes: bytes,
     text: str,
@@ -13,172 +25,268 @@ def add_speech_bubble(
     max_bubble_width: int = 200,
     min_font_size: int = 6
 ) -> bytes:
+    """Bytes-обёртка над draw_speech_bubble: декодирует картинку, рисует пузырь, кодирует обратно в PNG."""
     # Convert bytes to PIL Image
     image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+    draw_speech_bubble(image, text, head_x, head_y, font_path, max_bubble_width, min_font_size)
+
+    # Convert result back to bytes
+    output_buffer = io.BytesIO()
+    image.save(output_buffer, format='PNG')
+    return output_buffer.getvalue()
+
+
+def add_speech_bubbles(
+    image_bytes: bytes,
+    bubbles: list[tuple[str, float, float]],
+    font_path: str = None,
+    max_bubble_width: int = 200,
+    min_font_size: int = 6
+) -> bytes:
+    """Bytes-обёртка над draw_speech_bubbles: одно декодирование и одно кодирование на панель."""
+    image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+    draw_speech_bubbles(image, bubbles, font_path, max_bubble_width, min_font_size)
+
+    output_buffer = io.BytesIO()
+    image.save(output_buffer, format='PNG')
+    return output_buffer.getvalue()
+
+
+def draw_speech_bubble(
+    image: Image.Image,
+    text: str,
+    head_x: float,
+    head_y: float,
+    font_path: str = None,
+    max_bubble_width: int = 200,
+    min_font_size: int = 6
+) -> Image.Image:
+    """Рисует пузырь с репликой прямо на RGB-картинке PIL (in place) и возвращает её же."""
+    return draw_speech_bubbles(image, [(text, head_x, head_y)], font_path, max_bubble_width, min_font_size)
+
+
+def draw_speech_bubbles(
+    image: Image.Image,
+    bubbles: list[tuple[str, float, float]],
+    font_path: str = None,
+    max_bubble_width: int = 200,
+    min_font_size: int = 6
+) -> Image.Image:
+    """
+    Рисует все пузыри одной панели за один проход (in place) и возвращает картинку.
+
+    Пузыри раскладываются совместно: если прямоугольники пересекаются,
+    они раздвигаются по горизонтали, а если упёрлись в край — по вертикали.
+
+    Args:
+        image: RGB-картинка PIL
+        bubbles: список (текст, x головы, y головы); пустые реплики пропускаются
+    """
     draw = ImageDraw.Draw(image)
-    
-    # Style parameters
-    BORDER_COLOR = "black"
-    FILL_COLOR = "white"
-    BORDER_WIDTH = 3
-    TEXT_COLOR = "black"
-    
-    # Convert float coordinates to int
-    head_coords = (int(head_x), int(head_y))
-    
-    def compute_text_bubble_coords(
-        draw: ImageDraw.ImageDraw,
-        text: str,
-        head_coords: tuple[int, int],
-        font_path: str = None,
-        max_bubble_width: int = 200,
-        min_font_size: int = 6
-    ) -> tuple[tuple[int, int, int, int], ImageFont.FreeTypeFont, str]:
-        # Calculate font size based on text length
-        base_font_size = 40
-        scale = 1 / math.sqrt(len(text) / 20 + 1)
-        font_size = max(int(base_font_size * scale), min_font_size)
-        
-        # Safe font
-        try:
-            font = ImageFont.truetype(font_path or "arial.ttf", font_size)
-        except Exception:
-            font = ImageFont.load_default()
-        
-        # Wrap text
-        max_chars = max(1, int(max_bubble_width / (font_size * 0.6)))
-        wrapped_lines = textwrap.wrap(text, width=max_chars)
-        wrapped_text = "\n".join(wrapped_lines)
-        
-        # Calculate text size
-        text_bbox = draw.multiline_textbbox((0, 0), wrapped_text, font=font, spacing=4)
-        text_width = text_bbox[2] - text_bbox[0]
-        text_height = text_bbox[3] - text_bbox[1]
-        
-        # Calculate bubble rectangle coordinates around the head
-        head_x, head_y = head_coords
-        margin = 30
-        x1 = head_x - text_width // 2 - margin
-        y1 = head_y - text_height - 60
-        x2 = head_x + text_width // 2 + margin
-        y2 = y1 + text_height + margin * 2
-
-        # shift bubble a bit upward to not overlap faces
-        y1 -= 80
-        y2 -= 80
-
-        # Clamp within image bounds
-        img_w, img_h = image.size
-        # horizontal clamp
-        if x1 < 5:
-            dx = 5 - x1
-            x1 += dx; x2 += dx
-        elif x2 > img_w - 5:
-            dx = (img_w - 5) - x2
-            x1 += dx; x2 += dx
-        # vertical clamp
-        if y1 < 5:
-            dy = 5 - y1
-            y1 += dy; y2 += dy
-        elif y2 > img_h - 5:
-            dy = (img_h - 5) - y2
-            y1 += dy; y2 += dy
-
-        return (x1, y1, x2, y2), font, wrapped_text
-    
-    def interpolate_point(center, head, ratio=0.7):
-        cx, cy = center
-        hx, hy = head
-        return (int(cx + (hx - cx) * ratio), int(cy + (hy - cy) * ratio))
-    
-    def scale_polygon(points, scale):
-        cx = sum(p[0] for p in points) / len(points)
-        cy = sum(p[1] for p in points) / len(points)
-        return [(int(cx + (x - cx) * scale), int(cy + (y - cy) * scale)) for x, y in points]
-    
-    def get_ellipse_foci(x1, y1, x2, y2):
-        """Return two foci and center of the ellipse defined by bounding box."""
-        cx = (x1 + x2) // 2
-        cy = (y1 + y2) // 2
-        a = abs(x2 - x1) / 2
-        b = abs(y2 - y1) / 2
-        if a >= b:
-            c = math.sqrt(max(a * a - b * b, 0))
-            return (int(cx - c), cy), (int(cx + c), cy), (cx, cy)
-        else:
-            c = math.sqrt(max(b * b - a * a, 0))
-            return (cx, int(cy - c)), (cx, int(cy + c)), (cx, cy)
-
-    def draw_bubble_with_tail(
-        draw,
-        ellipse_coords,
-        head_coords,
-        wrapped_text,
-        font,
-        BORDER_COLOR="black",
-        FILL_COLOR="white",
-        BORDER_WIDTH=3,
-        TEXT_COLOR="black"
-    ):
-        # Draw tail
-        f1, f2, center = get_ellipse_foci(*ellipse_coords)
-        tip = interpolate_point(center, head_coords, ratio=0.7)
-        triangle = [f1, f2, tip]
-        
-        # Draw border (scaled triangle)
-        scale_factor = 1 + BORDER_WIDTH / 20.0
-        triangle_border = scale_polygon(triangle, scale_factor)
-        
-        # Draw border (ellipse)
-        border_coords = (
-            ellipse_coords[0] - BORDER_WIDTH,
-            ellipse_coords[1] - BORDER_WIDTH,
-            ellipse_coords[2] + BORDER_WIDTH,
-            ellipse_coords[3] + BORDER_WIDTH,
-        )
-        draw.ellipse(border_coords, fill=BORDER_COLOR)
-        draw.polygon(triangle_border, fill=BORDER_COLOR)
-        
-        # Draw white bubble
-        # Ensure ellipse coords ordered correctly after clamping
-        x1, y1, x2, y2 = ellipse_coords
-        if x1 > x2:
-            x1, x2 = x2, x1
-        if y1 > y2:
-            y1, y2 = y2, y1
-        ellipse_coords = (x1, y1, x2, y2)
-        draw.ellipse(ellipse_coords, fill=FILL_COLOR)
-        draw.polygon(triangle, fill=FILL_COLOR)
-        
-        # Draw text
-        x1, y1, x2, y2 = ellipse_coords
-        text_bbox = draw.multiline_textbbox((0, 0), wrapped_text, font=font, spacing=4)
-        text_w = text_bbox[2] - text_bbox[0]
-        text_h = text_bbox[3] - text_bbox[1]
-        cx = (x1 + x2) // 2
-        cy = (y1 + y2) // 2
-        text_x = cx - text_w // 2
-        text_y = cy - text_h // 2
-        
-        draw.multiline_text(
-            (text_x, text_y),
-            wrapped_text,
-            font=font,
-            fill=TEXT_COLOR,
-            align="center",
-            spacing=4
-        )
-    
-    if text.strip():
-        rect, font, wrapped_text = compute_text_bubble_coords(
-            draw, text, head_coords, font_path, max_bubble_width, min_font_size
+
+    layouts = []
+    for text, head_x, head_y in bubbles:
+        if not text or not text.strip():
+            continue
+        # Convert float coordinates to int
+        head_coords = (int(head_x), int(head_y))
+        rect, layout = compute_text_bubble_coords(
+            text, head_coords, image.size, font_path, max_bubble_width, min_font_size
         )
+        layouts.append((rect, head_coords, layout))
+
+    rects = resolve_overlaps([rect for rect, _head, _layout in layouts], image.size)
+    for (_rect, head_coords, layout), rect in zip(layouts, rects):
         draw_bubble_with_tail(
-            draw, rect, head_coords, wrapped_text, font,
-            BORDER_COLOR, FILL_COLOR, BORDER_WIDTH, TEXT_COLOR
+            draw, rect, head_coords, layout.wrapped_text, layout.font,
+            BORDER_COLOR, FILL_COLOR, BORDER_WIDTH, TEXT_COLOR,
+            text_size=(layout.width, layout.height),
         )
-    
-    # Convert result back to bytes
-    output_buffer = io.BytesIO()
-    image.save(output_buffer, format='PNG')
-    return output_buffer.getvalue()
\ No newline at end of file
+
+    return image
+
+
+def compute_text_bubble_coords(
+    text: str,
+    head_coords: tuple[int, int],
+    image_size: tuple[int, int],
+    font_path: str = None,
+    max_bubble_width: int = 200,
+    min_font_size: int = 6
+) -> tuple[tuple[int, int, int, int], TextLayout]:
+    # Размер шрифта подбирается по реальной ширине пузыря (шрифты и метрики кэшируются)
+    layout = TextLayoutEngine(font_path, min_font_size=min_font_size).fit(text, max_bubble_width)
+    text_width, text_height = layout.width, layout.height
+
+    # Calculate bubble rectangle coordinates around the head
+    head_x, head_y = head_coords
+    margin = 30
+    x1 = head_x - text_width // 2 - margin
+    y1 = head_y - text_height - 60
+    x2 = head_x + text_width // 2 + margin
+    y2 = y1 + text_height + margin * 2
+
+    # shift bubble a bit upward to not overlap faces
+    y1 -= 80
+    y2 -= 80
+
+    return clamp_rect((x1, y1, x2, y2), image_size), layout
+
+
+def clamp_rect(rect, image_size, pad: int = 5):
+    """Сдвигает прямоугольник внутрь картинки, сохраняя его размер."""
+    x1, y1, x2, y2 = rect
+    img_w, img_h = image_size
+    # horizontal clamp
+    if x1 < pad:
+        dx = pad - x1
+        x1 += dx; x2 += dx
+    elif x2 > img_w - pad:
+        dx = (img_w - pad) - x2
+        x1 += dx; x2 += dx
+    # vertical clamp
+    if y1 < pad:
+        dy = pad - y1
+        y1 += dy; y2 += dy
+    elif y2 > img_h - pad:
+        dy = (img_h - pad) - y2
+        y1 += dy; y2 += dy
+    return (x1, y1, x2, y2)
+
+
+def _overlap(a, b, gap: int) -> tuple[int, int]:
+    """Глубина пересечения двух прямоугольников по x и по y (с учётом зазора); <= 0 — не пересекаются."""
+    dx = min(a[2], b[2]) - max(a[0], b[0]) + gap
+    dy = min(a[3], b[3]) - max(a[1], b[1]) + gap
+    return dx, dy
+
+
+def resolve_overlaps(rects, image_size, gap: int = BUBBLE_GAP, max_rounds: int = 8):
+    """
+    Совместная раскладка пузырей одной панели: раздвигает пересекающиеся прямоугольники.
+
+    Сначала пара расталкивается по горизонтали (левый влево, правый вправо поровну);
+    если после прижатия к краям пересечение осталось — второй пузырь уходит по вертикали
+    туда, где хватает места.
+    """
+    rects = [tuple(r) for r in rects]
+    img_h = image_size[1]
+    for _round in range(max_rounds):
+        moved = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                a, b = rects[i], rects[j]
+                dx, dy = _overlap(a, b, gap)
+                if dx <= 0 or dy <= 0:
+                    continue
+                moved = True
+                # кто левее — тот едет влево
+                left, right = (i, j) if a[0] + a[2] <= b[0] + b[2] else (j, i)
+                shift_l = dx // 2 + dx % 2
+                shift_r = dx // 2
+                l, r = rects[left], rects[right]
+                rects[left] = clamp_rect((l[0] - shift_l, l[1], l[2] - shift_l, l[3]), image_size)
+                rects[right] = clamp_rect((r[0] + shift_r, r[1], r[2] + shift_r, r[3]), image_size)
+
+                dx, dy = _overlap(rects[i], rects[j], gap)
+                if dx > 0 and dy > 0:
+                    b = rects[j]
+                    a = rects[i]
+                    # ниже или выше первого пузыря — где хватает места
+                    if a[3] + gap + (b[3] - b[1]) <= img_h - 5:
+                        shift = a[3] + gap - b[1]
+                    else:
+                        shift = a[1] - gap - b[3]
+                    rects[j] = clamp_rect((b[0], b[1] + shift, b[2], b[3] + shift), image_size)
+        if not moved:
+            break
+    return rects
+
+
+def interpolate_point(center, head, ratio=0.7):
+    cx, cy = center
+    hx, hy = head
+    return (int(cx + (hx - cx) * ratio), int(cy + (hy - cy) * ratio))
+
+
+def scale_polygon(points, scale):
+    cx = sum(p[0] for p in points) / len(points)
+    cy = sum(p[1] for p in points) / len(points)
+    return [(int(cx + (x - cx) * scale), int(cy + (y - cy) * scale)) for x, y in points]
+
+
+def get_ellipse_foci(x1, y1, x2, y2):
+    """Return two foci and center of the ellipse defined by bounding box."""
+    cx = (x1 + x2) // 2
+    cy = (y1 + y2) // 2
+    a = abs(x2 - x1) / 2
+    b = abs(y2 - y1) / 2
+    if a >= b:
+        c = math.sqrt(max(a * a - b * b, 0))
+        return (int(cx - c), cy), (int(cx + c), cy), (cx, cy)
+    else:
+        c = math.sqrt(max(b * b - a * a, 0))
+        return (cx, int(cy - c)), (cx, int(cy + c)), (cx, cy)
+
+
+def draw_bubble_with_tail(
+    draw,
+    ellipse_coords,
+    head_coords,
+    wrapped_text,
+    font,
+    BORDER_COLOR="black",
+    FILL_COLOR="white",
+    BORDER_WIDTH=3,
+    TEXT_COLOR="black",
+    text_size=None
+):
+    # Draw tail
+    f1, f2, center = get_ellipse_foci(*ellipse_coords)
+    tip = interpolate_point(center, head_coords, ratio=0.7)
+    triangle = [f1, f2, tip]
+
+    # Draw border (scaled triangle)
+    scale_factor = 1 + BORDER_WIDTH / 20.0
+    triangle_border = scale_polygon(triangle, scale_factor)
+
+    # Draw border (ellipse)
+    border_coords = (
+        ellipse_coords[0] - BORDER_WIDTH,
+        ellipse_coords[1] - BORDER_WIDTH,
+        ellipse_coords[2] + BORDER_WIDTH,
+        ellipse_coords[3] + BORDER_WIDTH,
+    )
+    draw.ellipse(border_coords, fill=BORDER_COLOR)
+    draw.polygon(triangle_border, fill=BORDER_COLOR)
+
+    # Draw white bubble
+    # Ensure ellipse coords ordered correctly after clamping
+    x1, y1, x2, y2 = ellipse_coords
+    if x1 > x2:
+        x1, x2 = x2, x1
+    if y1 > y2:
+        y1, y2 = y2, y1
+    ellipse_coords = (x1, y1, x2, y2)
+    draw.ellipse(ellipse_coords, fill=FILL_COLOR)
+    draw.polygon(triangle, fill=FILL_COLOR)
+
+    # Draw text
+    x1, y1, x2, y2 = ellipse_coords
+    if text_size is None:
+        text_bbox = draw.multiline_textbbox((0, 0), wrapped_text, font=font, spacing=4)
+        text_size = (text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1])
+    text_w, text_h = text_size
+    cx = (x1 + x2) // 2
+    cy = (y1 + y2) // 2
+    text_x = cx - text_w // 2
+    text_y = cy - text_h // 2
+
+    draw.multiline_text(
+        (text_x, text_y),
+        wrapped_text,
+        font=font,
+        fill=TEXT_COLOR,
+        align="center",
+        spacing=4
+    )
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 from datetime import datetime
 from urllib.parse import quote, urlencode
@@ -11,10 +12,35 @@ try:
 except Exception:
     Image = ImageDraw = ImageFont = None
     _HAVE_PIL = False
-import time
+
+from .diskcache import DiskCache, make_key
+from .httpclient import get_session, http_timeout
+from .resilience import ClientHTTPError, check_http_response, get_breaker, get_retry_policy, is_retryable_http
 
 API_BASE = "https://image.pollinations.ai/prompt/"
 
+# Кэш результатов генерации: COMIX_IMAGE_CACHE=0 отключает его целиком
+CACHE_ENABLED = os.getenv("COMIX_IMAGE_CACHE", "1") != "0"
+CACHE_DIR = os.getenv("COMIX_IMAGE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "doc2comix", "images"))
+CACHE_MAX_MB = int(os.getenv("COMIX_IMAGE_CACHE_MAX_MB", "512"))
+CACHE_TTL = float(os.getenv("COMIX_IMAGE_CACHE_TTL", str(7 * 24 * 3600)))  # 0 — без TTL
+
+_cache = None
+
+
+def get_cache():
+    """Ленивая инициализация общего дискового кэша картинок (None, если кэш выключен)."""
+    global _cache
+    if CACHE_ENABLED and _cache is None:
+        _cache = DiskCache(CACHE_DIR, max_bytes=CACHE_MAX_MB * 1024 * 1024, ttl=CACHE_TTL)
+    return _cache
+
+
+def cache_key(prompt: str, width: int = None, height: int = None, seed: int = None, model: str = None) -> str:
+    # Нормализуем промпт: пробельные отличия не должны давать промах
+    normalized = re.sub(r"\s+", " ", prompt).strip()
+    return make_key("pollinations", normalized, width, height, seed, model)
+
 
 def build_url(prompt: str, width: int = None, height: int = None, seed: int = None, model: str = None) -> str:
     encoded_prompt = quote(prompt, safe="")
@@ -52,7 +78,16 @@ def get_content(resp: requests.Response, output_prefix: str = None):
     return resp.content, ext
 
 
-def _placeholder_image(prompt: str) -> bytes:
+def _fetch(url: str, timeout) -> requests.Response:
+    # Общая сессия: соединение с Pollinations переиспользуется между сценами и комиксами
+    resp = check_http_response(get_session().get(url, timeout=timeout))
+    if not resp.ok:
+        # 5xx и 429 уже отсеяны check_http_response — здесь остаётся ответ 4xx
+        raise ClientHTTPError(resp.status_code)
+    return resp
+
+
+def placeholder_image(prompt: str) -> bytes:
     """Return a minimal PNG placeholder. Uses PIL if available; otherwise a built-in PNG bytes."""
     if _HAVE_PIL:
         width, height = 832, 512
@@ -88,7 +123,8 @@ def generate_image(
     height: int = None,
     seed: int = None,
     model: str = None,
-    output: str = None
+    output: str = None,
+    use_cache: bool = True
 ) -> str:
     """
     Generate an image from a prompt or prompt file using the Pollinations API.
@@ -109,33 +145,67 @@ def generate_image(
     if not prompt_text:
         raise ValueError("Укажите prompt или prompt_file")
 
-    url = build_url(prompt_text, width=width, height=height, seed=seed, model=model)
+    try:
+        return fetch_image(prompt_text, width, height, seed, model, use_cache)
+    except Exception as e:
+        # Если все попытки не удались — возвращаем плейсхолдер
+        print(f"Сетевая ошибка генерации изображения: {e}", file=sys.stderr)
+        return placeholder_image(prompt_text), ".png"
 
-    # Ретраи при сетевых сбоях
-    attempts = 3
-    last_exc = None
-    for attempt in range(1, attempts + 1):
-        try:
-            resp = requests.get(url, timeout=45)
-            if resp.ok:
-                return get_content(resp, output)
-            last_exc = RuntimeError(f"HTTP ошибка: {resp.status_code}")
-        except Exception as e:
-            last_exc = e
-        # экспоненциальная пауза
-        time.sleep(1.5 * attempt)
 
-    # Если все попытки не удались — возвращаем плейсхолдер
-    print(f"Сетевая ошибка генерации изображения: {last_exc}", file=sys.stderr)
-    return _placeholder_image(prompt_text), ".png"
+def cached_image(prompt: str, width: int = None, height: int = None, seed: int = None, model: str = None):
+    """Картинка из дискового кэша или None (сеть не трогается)."""
+    cache = get_cache()
+    return cache.get(cache_key(prompt, width, height, seed, model)) if cache is not None else None
+
+
+def fetch_image(
+    prompt: str,
+    width: int = None,
+    height: int = None,
+    seed: int = None,
+    model: str = None,
+    use_cache: bool = True,
+    output: str = None,
+    lookup: bool = True,
+) -> tuple[bytes, str]:
+    """
+    Как generate_image, но без плейсхолдера: при неудаче бросает исключение.
+
+    Нужен там, где ошибку надо отличить от картинки (например, для переключения на другой бэкенд).
+    lookup=False — кэш уже проверен вызывающим (cached_image): сразу идём в сеть, ответ всё равно кэшируется.
+    """
+    cache = get_cache() if use_cache else None
+    key = cache_key(prompt, width, height, seed, model)
+    if cache is not None and lookup:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    url = build_url(prompt, width=width, height=height, seed=seed, model=model)
+
+    # Ретраи с джиттером в пределах крайнего срока задачи; лежащий бэкенд отсекается предохранителем
+    retry = get_retry_policy("pollinations", attempts=3, base_delay=1.5, timeout=http_timeout(), retryable=is_retryable_http)
+    resp = retry.call(lambda timeout: _fetch(url, timeout), breaker=get_breaker("pollinations"))
+
+    content, ext = get_content(resp, output)
+    # Кэшируем только настоящий ответ API (плейсхолдер в кэш не попадает)
+    if cache is not None:
+        cache.put(key, content, ext)
+    return content, ext
 
 
 if __name__ == "__main__":
+    # Модуль использует относительные импорты — запускать из корня репозитория:
+    #   python -m src.diffusion "промпт"
 
-    result = generate_image(
+    image_bytes, ext = generate_image(
+        sys.argv[1] if len(sys.argv) > 1 else "a cartoon cat reading a book, comic style",
         width=832,
         height=512,
         seed=42,
-        output="сгенерированная-картинка"
     )
-    print(f"Сохранено: {result}")
\ No newline at end of file
+    path = "сгенерированная-картинка" + ext
+    with open(path, "wb") as f:
+        f.write(image_bytes)
+    print(f"Сохранено: {path}")
\ No newline at end of file
@@ -0,0 +1,144 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Optional
+
+
+def make_key(*parts) -> str:
+    """Контент-адресный ключ: sha256 от нормализованного JSON-представления частей запроса."""
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class DiskCache:
+    """
+    Персистентный кэш байтов на диске, общий для нескольких процессов.
+
+    Каждая запись — один файл <dir>/<key[:2]>/<key><ext>. Запись атомарная
+    (временный файл + os.replace), поэтому параллельные воркеры не видят
+    недописанных файлов. Время последнего обращения хранится в atime файла
+    (LRU), время записи — в mtime (TTL).
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 512 * 1024 * 1024, ttl: Optional[float] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl or None
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0, 'errors': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def _bump(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += n
+
+    def _find(self, key: str) -> Optional[str]:
+        subdir = os.path.join(self.directory, key[:2])
+        try:
+            names = os.listdir(subdir)
+        except FileNotFoundError:
+            return None
+        for name in names:
+            # имена временных файлов начинаются с точки
+            if name.startswith(key):
+                return os.path.join(subdir, name)
+        return None
+
+    def get(self, key: str) -> Optional[tuple[bytes, str]]:
+        """Возвращает (данные, расширение) или None при промахе/просроченной записи."""
+        path = self._find(key)
+        if path is None:
+            self._bump('misses')
+            return None
+        try:
+            st = os.stat(path)
+            if self.ttl is not None and time.time() - st.st_mtime > self.ttl:
+                os.remove(path)
+                self._bump('misses')
+                self._bump('evictions')
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+            # отмечаем обращение для LRU, не трогая mtime (он нужен для TTL)
+            os.utime(path, (time.time(), st.st_mtime))
+        except FileNotFoundError:
+            # запись удалил другой процесс между поиском и чтением
+            self._bump('misses')
+            return None
+        self._bump('hits')
+        return data, path[len(os.path.join(self.directory, key[:2], key)):]
+
+    def put(self, key: str, data: bytes, ext: str = '') -> None:
+        subdir = os.path.join(self.directory, key[:2])
+        try:
+            os.makedirs(subdir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix='.', dir=subdir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, os.path.join(subdir, key + ext))
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+        except OSError as e:
+            # Кэш — оптимизация: ошибки диска не должны ронять генерацию
+            print(f"[cache] Не удалось записать {key}: {e}")
+            self._bump('errors')
+            return
+        self._bump('writes')
+        self.evict()
+
+    def evict(self) -> int:
+        """Удаляет просроченные записи, затем самые давно использованные, пока кэш больше max_bytes."""
+        now = time.time()
+        entries = []
+        total = 0
+        removed = 0
+        for root, _dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if self.ttl is not None and now - st.st_mtime > self.ttl:
+                    removed += self._remove(path)
+                    continue
+                entries.append((st.st_atime, st.st_size, path))
+                total += st.st_size
+
+        if self.max_bytes and total > self.max_bytes:
+            entries.sort()
+            for _atime, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                removed += self._remove(path)
+                total -= size
+
+        if removed:
+            self._bump('evictions', removed)
+        return removed
+
+    @staticmethod
+    def _remove(path: str) -> int:
+        try:
+            os.remove(path)
+            return 1
+        except FileNotFoundError:
+            return 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
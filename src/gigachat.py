@@ -1,7 +1,11 @@
 import json
 import time
 import base64
-import requests
+import threading
+from typing import Iterator, Optional
+
+from .httpclient import get_session, http_timeout
+from .resilience import check_http_response, current_deadline, get_breaker, get_retry_policy, is_retryable_http
 
 
 class FusionBrainAPI:
@@ -12,11 +16,28 @@ class FusionBrainAPI:
             'X-Key': f'Key {api_key}',
             'X-Secret': f'Secret {secret_key}',
         }
+        # Keep-alive сессия: запуск генерации и все опросы статуса идут по уже открытому соединению
+        self.session = get_session()
+        self._pipeline_id = None
+        self._pipeline_lock = threading.Lock()
+        self.retry = get_retry_policy("fusionbrain", attempts=3, timeout=http_timeout(), retryable=is_retryable_http)
+        self.breaker = get_breaker("fusionbrain")
+
+    def _request(self, method, path, **kwargs):
+        """Запрос к API с повторами, предохранителем и таймаутом, ужатым до крайнего срока задачи."""
+        def send(timeout):
+            response = self.session.request(method, self.URL + path, headers=self.AUTH_HEADERS, timeout=timeout, **kwargs)
+            return check_http_response(response)
+        return self.retry.call(send, breaker=self.breaker)
 
     def get_pipeline(self):
-        response = requests.get(self.URL + 'key/api/v1/pipelines', headers=self.AUTH_HEADERS)
-        data = response.json()
-        return data[0]['id']
+        # id пайплайна не меняется между генерациями — запрашиваем его один раз на клиент
+        with self._pipeline_lock:
+            if self._pipeline_id is None:
+                response = self._request('GET', 'key/api/v1/pipelines')
+                data = response.json()
+                self._pipeline_id = data[0]['id']
+            return self._pipeline_id
 
     def generate(self, promt, pipeline_id, images=1, width=1024, height=1024):
         params = {
@@ -34,20 +55,85 @@ class FusionBrainAPI:
             'pipeline_id': (None, pipeline_id),
             'params': (None, json.dumps(params), 'application/json')
         }
-        response = requests.post(self.URL + 'key/api/v1/pipeline/run', headers=self.AUTH_HEADERS, files=data)
+        response = self._request('POST', 'key/api/v1/pipeline/run', files=data)
         data = response.json()
         return data['uuid']
 
+    def get_status(self, request_id):
+        response = self._request('GET', 'key/api/v1/pipeline/status/' + request_id)
+        return response.json()
+
     def check_generation(self, request_id, attempts=10, delay=10):
         while attempts > 0:
-            response = requests.get(self.URL + 'key/api/v1/pipeline/status/' + request_id, headers=self.AUTH_HEADERS)
-            data = response.json()
+            data = self.get_status(request_id)
             if data['status'] == 'DONE':
                 return data['result']['files']
 
             attempts -= 1
             time.sleep(delay)
 
+    def generate_batch(
+        self,
+        prompts: list,
+        width: int = 1024,
+        height: int = 1024,
+        timeout: float = 300,
+        min_delay: float = 1.0,
+        max_delay: float = 10.0,
+    ) -> Iterator[tuple[int, Optional[list]]]:
+        """
+        Пакетная генерация: сначала отправляет все промпты, потом опрашивает все задачи в одном цикле.
+
+        Пауза между раундами опроса адаптивная: сбрасывается к min_delay, когда что-то
+        готово, и растёт в 1.5 раза (до max_delay), пока ничего не меняется. Так общее
+        время близко к времени одной генерации, а не N x (очередь + шаг опроса).
+
+        Yields:
+            (индекс промпта, список base64-картинок) по мере готовности, не по порядку.
+            Для неудачных задач (ошибка отправки, FAIL, таймаут) вместо списка — None.
+        """
+        pipeline_id = self.get_pipeline()
+        pending = {}
+        for index, prompt in enumerate(prompts):
+            try:
+                pending[self.generate(prompt, pipeline_id, width=width, height=height)] = index
+            except Exception as e:
+                print(f"[fusionbrain] Не удалось отправить промпт {index + 1}: {e}")
+                yield index, None
+
+        job_deadline = current_deadline()
+        if job_deadline is not None:
+            timeout = min(timeout, job_deadline.remaining())
+        deadline = time.monotonic() + timeout
+        delay = min_delay
+        while pending:
+            if time.monotonic() >= deadline:
+                for index in pending.values():
+                    print(f"[fusionbrain] Генерация {index + 1} не успела за {timeout:.0f} с")
+                    yield index, None
+                return
+            time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+
+            progressed = False
+            for request_id, index in list(pending.items()):
+                try:
+                    data = self.get_status(request_id)
+                except Exception as e:
+                    # Сбой одного опроса — не повод бросать задачу, спросим в следующем раунде
+                    print(f"[fusionbrain] Ошибка опроса {request_id}: {e}")
+                    continue
+                status = data.get('status')
+                if status == 'DONE':
+                    del pending[request_id]
+                    progressed = True
+                    yield index, data['result']['files']
+                elif status == 'FAIL':
+                    del pending[request_id]
+                    progressed = True
+                    print(f"[fusionbrain] Генерация {index + 1} завершилась ошибкой: {data.get('errorDescription')}")
+                    yield index, None
+            delay = min_delay if progressed else min(max_delay, delay * 1.5)
+
     def get_images_as_bytes(self, base64_strings):
         """
         Конвертирует base64 строки в bytes
@@ -62,11 +148,24 @@ class FusionBrainAPI:
         return images_bytes
 
 
+_api = None
+_api_lock = threading.Lock()
+
+
+def get_api() -> FusionBrainAPI:
+    """Общий на процесс клиент FusionBrain (создаётся при первом вызове)."""
+    global _api
+    with _api_lock:
+        if _api is None:
+            _api = FusionBrainAPI('https://api-key.fusionbrain.ai/', 'D2E7D31A8BB9A85A81D81CDA503F00E6', '85049FCF053B537DEA02BF956A63112D')
+    return _api
+
+
 # Измененная функция generate_image
-def generate_image(prompt):
-    api = FusionBrainAPI('https://api-key.fusionbrain.ai/', 'D2E7D31A8BB9A85A81D81CDA503F00E6', '85049FCF053B537DEA02BF956A63112D')
+def generate_image(prompt, width=1024, height=1024):
+    api = get_api()
     pipeline_id = api.get_pipeline()
-    uuid = api.generate(prompt, pipeline_id)
+    uuid = api.generate(prompt, pipeline_id, width=width, height=height)
     base64_files = api.check_generation(uuid)
     
     if base64_files:
@@ -77,7 +176,24 @@ def generate_image(prompt):
     return None, None
 
 
+def generate_images_batch(prompts: list, width: int = 1024, height: int = 1024) -> Iterator[tuple[int, Optional[bytes], Optional[str]]]:
+    """
+    Пакетный вариант generate_image: все промпты отправляются сразу, картинки отдаются по мере готовности.
+
+    Yields:
+        (индекс промпта, bytes картинки, '.jpg'); для неудачных — (индекс, None, None).
+    """
+    api = get_api()
+    for index, base64_files in api.generate_batch(prompts, width=width, height=height):
+        images_bytes = api.get_images_as_bytes(base64_files) if base64_files else []
+        if images_bytes:
+            yield index, images_bytes[0], '.jpg'
+        else:
+            yield index, None, None
+
+
 if __name__ == '__main__':
+    # Модуль использует относительные импорты — запускать из корня репозитория: python -m src.gigachat
     promt = """Ivan on the left and Anna on the right are sitting on a bench in a messy urban park. Ivan is pointing towards a pile of uncollected garbage bags near a playground. He looks upset.
     Appearance of left character:
 A young man in his late 20s, named Ivan. He has short, slightly messy brown hair, wears a simple t-shirt and jeans. He looks confused and a bit frustrated at first, then engaged and happy.
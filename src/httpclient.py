@@ -0,0 +1,86 @@
+from __future__ import annotations
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Таймауты HTTP (сек): соединение и чтение ответа настраиваются отдельно
+CONNECT_TIMEOUT = float(os.getenv("COMIX_HTTP_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("COMIX_HTTP_READ_TIMEOUT", "60"))
+# Нестримовый ответ LLM на длинный сценарий приходит целиком, поэтому чтение ждём дольше
+LLM_READ_TIMEOUT = float(os.getenv("COMIX_LLM_READ_TIMEOUT", "300"))
+
+# Размер пула keep-alive соединений на хост: по умолчанию с запасом на все воркеры рендера
+# (несколько комиксов могут рисоваться одновременно), но не меньше 10
+POOL_SIZE = int(os.getenv(
+    "COMIX_HTTP_POOL_SIZE",
+    str(max(10, 2 * int(os.getenv("COMIX_IMAGE_WORKERS", "4")))),
+))
+
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+
+_session = None
+_openai_client = None
+_lock = threading.Lock()
+
+
+def http_timeout(read: float = None) -> tuple[float, float]:
+    """Таймаут в формате requests: (соединение, чтение)."""
+    return CONNECT_TIMEOUT, READ_TIMEOUT if read is None else read
+
+
+def get_session() -> requests.Session:
+    """
+    Общая на процесс requests.Session с пулом keep-alive соединений.
+
+    Повторные запросы к тому же хосту (Pollinations, FusionBrain) переиспользуют
+    уже открытые TLS-соединения вместо нового рукопожатия на каждый запрос.
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                session = requests.Session()
+                # Ретраи делают вызывающие функции сами, поэтому адаптер их не добавляет
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def get_openai_client():
+    """
+    Общий на процесс клиент OpenRouter (OpenAI-совместимый API).
+
+    .env читается один раз; httpx-пул клиента рассчитан на параллельные
+    запросы суммаризации и нескольких одновременных комиксов.
+    """
+    global _openai_client
+    if _openai_client is None:
+        with _lock:
+            if _openai_client is None:
+                import httpx
+                from openai import OpenAI
+                try:
+                    from dotenv import load_dotenv, find_dotenv
+                    load_dotenv(find_dotenv())
+                except Exception:
+                    pass
+
+                api_key = os.getenv("OPENROUTER_API_KEY")
+                if not api_key:
+                    raise RuntimeError("OPENROUTER_API_KEY не найден в окружении/.env")
+
+                _openai_client = OpenAI(
+                    base_url=OPENROUTER_BASE_URL,
+                    api_key=api_key,
+                    timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+                    # Повторы делает политика из resilience (с учётом крайнего срока задачи), а не SDK
+                    max_retries=0,
+                    http_client=httpx.Client(
+                        limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE),
+                    ),
+                )
+    return _openai_client
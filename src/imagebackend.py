@@ -0,0 +1,265 @@
+from __future__ import annotations
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from typing import Iterator, Optional, Protocol
+
+from . import diffusion, gigachat
+
+# Основной бэкенд картинок и запасной (пусто/none — без запасного)
+IMAGE_BACKEND = os.getenv("COMIX_IMAGE_BACKEND", "pollinations")
+IMAGE_FALLBACK = os.getenv("COMIX_IMAGE_FALLBACK", "")
+# Хеджирование: если основной бэкенд не ответил за свой p90, параллельно запускаем запасной
+HEDGE_ENABLED = os.getenv("COMIX_IMAGE_HEDGE", "0") == "1"
+# Сколько замеров нужно, чтобы доверять p90 (до этого хеджирования нет, только failover)
+HEDGE_MIN_SAMPLES = int(os.getenv("COMIX_HEDGE_MIN_SAMPLES", "10"))
+# Сколько промптов пакета бэкенд без своего пакетного API генерирует одновременно
+BATCH_WORKERS = int(os.getenv("COMIX_IMAGE_WORKERS", "4"))
+
+# Элемент результата generate_batch: (индекс промпта, bytes картинки, расширение); при неудаче — (индекс, None, None)
+BatchItem = tuple[int, Optional[bytes], Optional[str]]
+
+
+class ImageBackend(Protocol):
+    """
+    Бэкенд генерации картинок: generate() возвращает (bytes, расширение) или бросает исключение.
+
+    generate_batch() генерирует несколько промптов сразу и отдаёт BatchItem по мере готовности
+    (не по порядку); ошибка одного промпта не прерывает пакет. prefers_batch — бэкенду выгоднее
+    получить все промпты одним пакетом, чем по одному (например, общий цикл опроса статуса).
+    """
+    name: str
+    latency: "LatencyTracker"
+    prefers_batch: bool
+
+    def generate(self, prompt: str, width: int, height: int) -> tuple[bytes, str]:
+        ...
+
+    def generate_batch(self, prompts: list, width: int, height: int) -> Iterator[BatchItem]:
+        ...
+
+
+class LatencyTracker:
+    """Скользящее окно длительностей успешных сетевых вызовов (попадания в кэш не учитываются)."""
+
+    def __init__(self, window: int = 100):
+        self._samples: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def _concurrent_batch(backend: ImageBackend, prompts: list, width: int, height: int) -> Iterator[BatchItem]:
+    """Пакет для бэкенда без пакетного API: промпты идут через generate() параллельно, по BATCH_WORKERS."""
+    with ThreadPoolExecutor(max_workers=max(1, min(BATCH_WORKERS, len(prompts))),
+                            thread_name_prefix=f"{backend.name}-batch") as pool:
+        # copy_context: крайний срок задачи действует и в потоках пакета
+        futures = {
+            pool.submit(contextvars.copy_context().run, backend.generate, prompt, width, height): index
+            for index, prompt in enumerate(prompts)
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                image_bytes, ext = future.result()
+            except Exception as e:
+                print(f"[images] {backend.name}: промпт {index + 1} пакета не удался ({e})")
+                yield index, None, None
+            else:
+                yield index, image_bytes, ext
+
+
+class PollinationsBackend:
+    name = "pollinations"
+    prefers_batch = False
+
+    def __init__(self):
+        self.latency = LatencyTracker()
+
+    def generate(self, prompt: str, width: int, height: int) -> tuple[bytes, str]:
+        cached = diffusion.cached_image(prompt, width, height)
+        if cached is not None:
+            return cached
+        started = time.monotonic()
+        # Кэш только что проверен — повторно в него не смотрим
+        result = diffusion.fetch_image(prompt, width=width, height=height, lookup=False)
+        self.latency.record(time.monotonic() - started)
+        return result
+
+    def generate_batch(self, prompts: list, width: int, height: int) -> Iterator[BatchItem]:
+        return _concurrent_batch(self, prompts, width, height)
+
+
+class FusionBrainBackend:
+    name = "fusionbrain"
+    # Все задачи пакета опрашиваются в одном цикле — N картинок готовы примерно за время одной
+    prefers_batch = True
+
+    def __init__(self):
+        self.latency = LatencyTracker()
+
+    def generate(self, prompt: str, width: int, height: int) -> tuple[bytes, str]:
+        for _index, image_bytes, ext in self.generate_batch([prompt], width, height):
+            if image_bytes:
+                return image_bytes, ext
+        raise RuntimeError("FusionBrain не вернул картинку")
+
+    def generate_batch(self, prompts: list, width: int, height: int) -> Iterator[BatchItem]:
+        started = time.monotonic()
+        # Опрос статуса с адаптивной паузой вместо фиксированных 10 с
+        for index, image_bytes, ext in gigachat.generate_images_batch(prompts, width=width, height=height):
+            if image_bytes:
+                self.latency.record(time.monotonic() - started)
+                yield index, image_bytes, ext
+            else:
+                yield index, None, None
+
+
+BACKENDS = {
+    PollinationsBackend.name: PollinationsBackend,
+    FusionBrainBackend.name: FusionBrainBackend,
+}
+
+
+class FailoverImageBackend:
+    """
+    Основной бэкенд с запасным.
+
+    Failover: ошибка основного (в том числе быстрый отказ разомкнутого предохранителя)
+    — запрос уходит в запасной. Хеджирование (hedge=True): если основной не ответил
+    за свой p90, запасной запускается параллельно и берётся первый успешный ответ.
+    Проигравший запрос не отменяется (HTTP-вызов не прервать), его результат отбрасывается.
+
+    В пакетном режиме (generate_batch) хеджирования нет: весь пакет уходит в основной
+    бэкенд, а не удавшиеся в нём промпты — одним пакетом в запасной.
+    """
+
+    def __init__(self, primary: ImageBackend, secondary: ImageBackend, hedge: bool = False,
+                 min_samples: int = HEDGE_MIN_SAMPLES, max_workers: int = 16):
+        self.primary = primary
+        self.secondary = secondary
+        self.hedge = hedge
+        self.min_samples = min_samples
+        self.name = f"{primary.name}+{secondary.name}"
+        self.latency = primary.latency
+        self.prefers_batch = primary.prefers_batch
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-backend")
+        self._lock = threading.Lock()
+        self._counters = {'calls': 0, 'failovers': 0, 'hedges': 0, 'hedge_wins': 0, 'failures': 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def hedge_delay(self) -> Optional[float]:
+        """Через сколько секунд звать запасной бэкенд (None — хеджирование сейчас не применяется)."""
+        if not self.hedge or len(self.primary.latency) < self.min_samples:
+            return None
+        return self.primary.latency.percentile(0.9)
+
+    def _submit(self, backend: ImageBackend, prompt: str, width: int, height: int):
+        # copy_context: крайний срок задачи действует и в потоке бэкенда
+        return self._executor.submit(contextvars.copy_context().run, backend.generate, prompt, width, height)
+
+    def generate(self, prompt: str, width: int, height: int) -> tuple[bytes, str]:
+        self._count('calls')
+        delay = self.hedge_delay()
+        if delay is None:
+            try:
+                return self.primary.generate(prompt, width, height)
+            except Exception as e:
+                print(f"[images] {self.primary.name} не справился ({e}), пробую {self.secondary.name}")
+                self._count('failovers')
+                try:
+                    return self.secondary.generate(prompt, width, height)
+                except Exception:
+                    self._count('failures')
+                    raise
+
+        primary = self._submit(self.primary, prompt, width, height)
+        done, _ = wait([primary], timeout=delay)
+        if done and primary.exception() is None:
+            return primary.result()
+        if done:
+            self._count('failovers')
+        else:
+            self._count('hedges')
+        secondary = self._submit(self.secondary, prompt, width, height)
+
+        pending = {primary, secondary} - done
+        errors = [primary.exception()] if done else []
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                if future.exception() is None:
+                    if future is secondary and not done:
+                        self._count('hedge_wins')
+                    return future.result()
+                errors.append(future.exception())
+        self._count('failures')
+        raise errors[-1]
+
+    def generate_batch(self, prompts: list, width: int, height: int) -> Iterator[BatchItem]:
+        with self._lock:
+            self._counters['calls'] += len(prompts)
+        failed = []
+        for index, image_bytes, ext in self.primary.generate_batch(prompts, width, height):
+            if image_bytes is not None:
+                yield index, image_bytes, ext
+            else:
+                failed.append(index)
+        if not failed:
+            return
+        print(f"[images] {self.primary.name} не справился с {len(failed)} промптами, пробую {self.secondary.name}")
+        with self._lock:
+            self._counters['failovers'] += len(failed)
+        for j, image_bytes, ext in self.secondary.generate_batch([prompts[i] for i in failed], width, height):
+            if image_bytes is None:
+                self._count('failures')
+            yield failed[j], image_bytes, ext
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+        counters['primary_p90'] = self.primary.latency.percentile(0.9)
+        counters['secondary_p90'] = self.secondary.latency.percentile(0.9)
+        return counters
+
+
+def make_backend(name: str) -> ImageBackend:
+    try:
+        return BACKENDS[name.strip().lower()]()
+    except KeyError:
+        raise ValueError(f"Неизвестный бэкенд картинок: {name!r} (доступны: {', '.join(BACKENDS)})") from None
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_image_backend() -> ImageBackend:
+    """Общий на процесс бэкенд картинок по настройкам COMIX_IMAGE_BACKEND / COMIX_IMAGE_FALLBACK / COMIX_IMAGE_HEDGE."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            backend = make_backend(IMAGE_BACKEND)
+            if IMAGE_FALLBACK and IMAGE_FALLBACK.lower() != "none":
+                backend = FailoverImageBackend(backend, make_backend(IMAGE_FALLBACK), hedge=HEDGE_ENABLED)
+            _backend = backend
+    return _backend
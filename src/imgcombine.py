@@ -1,26 +1,123 @@
 from __future__ import annotations
+from typing import Optional
 from PIL import Image
 import io
 import math
+import os
 
-def combine_images_to_file(image_bytes_list: list[bytes], output_path: str, gap: int = 10) -> None:
-    first_image = Image.open(io.BytesIO(image_bytes_list[0]))
-    width, height = first_image.size
-    num_images = len(image_bytes_list)
+# Расширение файла -> формат PIL
+_EXT_FORMATS = {'.png': 'PNG', '.jpg': 'JPEG', '.jpeg': 'JPEG', '.webp': 'WEBP'}
+
+
+def _as_image(item) -> Image.Image:
+    """Панель, PIL-картинка или закодированные bytes -> RGB-картинка PIL (bytes декодируются только здесь)."""
+    image = getattr(item, 'image', item)
+    if isinstance(image, (bytes, bytearray)):
+        image = Image.open(io.BytesIO(image))
+    return image if image.mode == 'RGB' else image.convert('RGB')
+
+
+def _save_kwargs(fmt: str, quality: int) -> dict:
+    fmt = fmt.upper()
+    if fmt == 'JPEG':
+        return {'quality': quality, 'optimize': True}
+    if fmt == 'WEBP':
+        return {'quality': quality, 'method': 4}
+    return {}
+
+
+def compose_images(images: list, gap: int = 10, max_side: Optional[int] = None) -> Image.Image:
+    """
+    Склеивает панели в сетку по две в ряд (нечётная последняя — по центру).
+
+    Если задан max_side, итоговый холст сразу создаётся уменьшенным, а каждая
+    панель масштабируется в момент вставки — полноразмерный холст не строится.
+    """
+    width, height = _as_image(images[0]).size
+    num_images = len(images)
     num_rows = math.ceil(num_images / 2)
     output_width = width * 2 + gap
     output_height = height * num_rows + gap * (num_rows - 1)
-    result_image = Image.new('RGB', (output_width, output_height), color='white')
-    
-    for i, img_bytes in enumerate(image_bytes_list):
-        img = Image.open(io.BytesIO(img_bytes)).convert('RGB')
+
+    scale = 1.0
+    if max_side and max(output_width, output_height) > max_side:
+        scale = max_side / float(max(output_width, output_height))
+    panel_w, panel_h = max(1, int(width * scale)), max(1, int(height * scale))
+    gap_s = int(gap * scale)
+    result_image = Image.new(
+        'RGB',
+        (panel_w * 2 + gap_s, panel_h * num_rows + gap_s * (num_rows - 1)),
+        color='white',
+    )
+
+    for i, item in enumerate(images):
+        img = _as_image(item)
+        if img.size != (panel_w, panel_h):
+            img = img.resize((panel_w, panel_h), Image.LANCZOS)
         row = i // 2
         col = i % 2
         if i == num_images - 1 and num_images % 2 == 1:
-            x_offset = width // 2 + gap // 2
+            x_offset = panel_w // 2 + gap_s // 2
         else:
-            x_offset = col * (width + gap)
-        y_offset = row * (height + gap)
+            x_offset = col * (panel_w + gap_s)
+        y_offset = row * (panel_h + gap_s)
         result_image.paste(img, (x_offset, y_offset))
-    
-    result_image.save(output_path, format='PNG')
\ No newline at end of file
+
+    return result_image
+
+
+def combine_images(
+    images: list,
+    gap: int = 10,
+    format: str = 'PNG',
+    quality: int = 85,
+    max_side: Optional[int] = None,
+) -> bytes:
+    """Склеивает панели и сразу кодирует результат в нужный формат (PNG/JPEG/WEBP), возвращая байты."""
+    buf = io.BytesIO()
+    compose_images(images, gap, max_side).save(buf, format=format, **_save_kwargs(format, quality))
+    return buf.getvalue()
+
+
+def combine_images_to_file(
+    image_bytes_list: list,
+    output_path: str,
+    gap: int = 10,
+    format: Optional[str] = None,
+    quality: int = 85,
+    max_side: Optional[int] = None,
+) -> None:
+    """
+    Склеивает панели и пишет файл сразу в целевом формате.
+
+    format по умолчанию берётся из расширения output_path (неизвестное расширение — PNG).
+    """
+    if format is None:
+        format = _EXT_FORMATS.get(os.path.splitext(output_path)[1].lower(), 'PNG')
+    result_image = compose_images(image_bytes_list, gap, max_side)
+    result_image.save(output_path, format=format, **_save_kwargs(format, quality))
+
+
+def page_path(output_path: str, number: int) -> str:
+    """Путь к странице number (с единицы): 'dir/comic.jpg' -> 'dir/comic_p<number>.jpg'."""
+    root, ext = os.path.splitext(output_path)
+    return f"{root}_p{number}{ext}"
+
+
+def write_page(
+    images: list,
+    output_path: str,
+    number: int,
+    gap: int = 10,
+    format: Optional[str] = None,
+    quality: int = 85,
+    max_side: Optional[int] = None,
+) -> str:
+    """Собирает одну страницу из панелей images и пишет её в page_path(output_path, number); возвращает путь."""
+    path = page_path(output_path, number)
+    if format is None:
+        format = _EXT_FORMATS.get(os.path.splitext(output_path)[1].lower(), 'PNG')
+    page = compose_images(images, gap, max_side)
+    page.save(path, format=format, **_save_kwargs(format, quality))
+    page.close()
+    return path
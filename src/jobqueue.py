@@ -0,0 +1,124 @@
+from __future__ import annotations
+import threading
+import traceback
+from collections import deque
+from typing import Callable, Hashable
+
+
+class QueueFull(Exception):
+    """Очередь заполнена — новая задача не принята."""
+
+
+class UserLimitExceeded(Exception):
+    """У пользователя уже максимум задач в очереди/работе."""
+
+
+class JobQueue:
+    """
+    Очередь задач с пулом воркеров и лимитом задач на пользователя.
+
+    submit() не блокируется: задача ставится в FIFO-очередь и выполняется одним
+    из workers потоков. Если в очереди уже max_queue ожидающих задач или у
+    пользователя per_user_limit задач (ожидающих + выполняющихся), задача
+    отклоняется исключением — это и есть контроль допуска.
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 20, per_user_limit: int = 1):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.per_user_limit = per_user_limit
+        self._cond = threading.Condition()
+        self._pending: deque = deque()
+        self._per_user: dict = {}
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._threads: list[threading.Thread] = []
+        self._stopping = False
+
+    def start(self) -> None:
+        with self._cond:
+            if self._threads:
+                return
+            for n in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"job-worker-{n}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, user_id: Hashable, fn: Callable, *args, **kwargs) -> int:
+        """
+        Ставит fn(*args, **kwargs) в очередь от имени user_id.
+
+        Returns:
+            Сколько задач должно завершиться до её старта (0 — стартует сразу, есть свободный воркер).
+
+        Raises:
+            UserLimitExceeded: у пользователя уже per_user_limit задач.
+            QueueFull: уже max_queue задач ждут свободного воркера.
+        """
+        self.start()
+        with self._cond:
+            if self.per_user_limit and self._per_user.get(user_id, 0) >= self.per_user_limit:
+                self._rejected += 1
+                raise UserLimitExceeded(f"У пользователя {user_id} уже {self.per_user_limit} задач(и) в работе")
+            # свободные воркеры сразу разберут часть ожидающих задач; остальные реально стоят в очереди
+            waiting = max(0, len(self._pending) - (self.workers - self._running))
+            if waiting >= self.max_queue:
+                self._rejected += 1
+                raise QueueFull(f"Очередь заполнена ({self.max_queue})")
+            ahead = waiting + 1 if self._running + len(self._pending) >= self.workers else 0
+            self._pending.append((user_id, fn, args, kwargs))
+            self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+            self._cond.notify()
+            return ahead
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if self._stopping and not self._pending:
+                    return
+                user_id, fn, args, kwargs = self._pending.popleft()
+                self._running += 1
+            ok = False
+            try:
+                fn(*args, **kwargs)
+                ok = True
+            except Exception:
+                # Задача сама сообщает пользователю об ошибке; здесь только не даём упасть воркеру
+                traceback.print_exc()
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    if ok:
+                        self._completed += 1
+                    else:
+                        self._failed += 1
+                    left = self._per_user.get(user_id, 1) - 1
+                    if left > 0:
+                        self._per_user[user_id] = left
+                    else:
+                        self._per_user.pop(user_id, None)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Дорабатывает уже принятые задачи и останавливает воркеры."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            threads = list(self._threads)
+        if wait:
+            for t in threads:
+                t.join()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'pending': len(self._pending),
+                'running': self._running,
+                'completed': self._completed,
+                'failed': self._failed,
+                'rejected': self._rejected,
+            }
@@ -0,0 +1,96 @@
+from __future__ import annotations
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from .diskcache import make_key
+
+
+class CompletionCache:
+    """
+    Кэш ответов LLM: LRU в памяти плюс необязательный SQLite-уровень на диске.
+
+    Значение — (текст ответа, число токенов запроса+ответа); токены нужны,
+    чтобы считать, сколько мы сэкономили на попаданиях.
+    """
+
+    def __init__(self, max_entries: int = 256, sqlite_path: Optional[str] = None, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl or None
+        self._memory: OrderedDict[str, tuple[str, int, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'writes': 0, 'saved_tokens': 0}
+        self._db = None
+        if sqlite_path:
+            os.makedirs(os.path.dirname(os.path.abspath(sqlite_path)), exist_ok=True)
+            # одно соединение на процесс, доступ сериализуем своей блокировкой
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False, timeout=30)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS completions ('
+                'key TEXT PRIMARY KEY, text TEXT NOT NULL, tokens INTEGER NOT NULL, created REAL NOT NULL)'
+            )
+            self._db.commit()
+
+    @staticmethod
+    def key(model: str, prompt: str, params: dict) -> str:
+        return make_key('completion', model, prompt, params)
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[2]):
+                self._memory.move_to_end(key)
+                self._hit('memory_hits', entry[1])
+                return entry[0]
+            if entry is not None:
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    'SELECT text, tokens, created FROM completions WHERE key = ?', (key,)
+                ).fetchone()
+                if row is not None and not self._expired(row[2]):
+                    self._remember(key, row)
+                    self._hit('disk_hits', row[1])
+                    return row[0]
+
+            self._counters['misses'] += 1
+            return None
+
+    def put(self, key: str, text: str, tokens: int = 0) -> None:
+        entry = (text, tokens or 0, time.time())
+        with self._lock:
+            self._remember(key, entry)
+            self._counters['writes'] += 1
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO completions (key, text, tokens, created) VALUES (?, ?, ?, ?)',
+                    (key, *entry),
+                )
+                self._db.commit()
+
+    def _remember(self, key: str, entry) -> None:
+        self._memory[key] = tuple(entry)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _hit(self, tier: str, tokens: int) -> None:
+        self._counters['hits'] += 1
+        self._counters[tier] += 1
+        self._counters['saved_tokens'] += tokens
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._memory)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
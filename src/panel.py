@@ -0,0 +1,37 @@
+from __future__ import annotations
+import io
+
+import numpy as np
+from PIL import Image
+
+
+class Panel:
+    """
+    Панель комикса, декодированная один раз.
+
+    Между этапами (детекция лиц, пузырьки, склейка) картинка живёт как RGB-изображение PIL;
+    кодирование в PNG/JPEG происходит только на границах — при получении от API и при выдаче наружу.
+    """
+
+    def __init__(self, image: Image.Image):
+        self.image = image if image.mode == 'RGB' else image.convert('RGB')
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Panel":
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        return cls(image)
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.image.size
+
+    @property
+    def array(self) -> np.ndarray:
+        """RGB ndarray (H, W, 3) — копия текущего состояния картинки, например для детектора."""
+        return np.asarray(self.image)
+
+    def to_bytes(self, format: str = 'PNG', **save_kwargs) -> bytes:
+        buf = io.BytesIO()
+        self.image.save(buf, format=format, **save_kwargs)
+        return buf.getvalue()
@@ -1,27 +1,120 @@
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import PyPDF2
 
-def extract_text_from_pdf(file_path):
+from .diskcache import DiskCache, make_key
+
+# Начиная с какого числа страниц имеет смысл поднимать пул процессов
+PARALLEL_MIN_PAGES = 16
+DEFAULT_WORKERS = int(os.getenv("COMIX_PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+CACHE_ENABLED = os.getenv("COMIX_PDF_CACHE", "1") != "0"
+CACHE_DIR = os.getenv("COMIX_PDF_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "doc2comix", "pdftext"))
+
+_cache = None
+
+
+def _get_cache():
+    global _cache
+    if CACHE_ENABLED and _cache is None:
+        _cache = DiskCache(CACHE_DIR, max_bytes=256 * 1024 * 1024)
+    return _cache
+
+
+def file_hash(file_path):
+    """sha256 содержимого файла (ключ кэша не зависит от имени и пути)."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _page_bounds(num_pages, page_range=None, max_pages=None):
+    start, stop = page_range if page_range else (0, num_pages)
+    start = max(0, start)
+    stop = min(num_pages, num_pages if stop is None else stop)
+    if max_pages is not None:
+        stop = min(stop, start + max_pages)
+    return start, max(start, stop)
+
+
+def _extract_range(file_path, start, stop):
+    """Текст страниц [start, stop) — выполняется в отдельном процессе пула."""
+    with open(file_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        return [pdf_reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+def extract_pages_from_pdf(file_path, page_range=None, max_pages=None, workers=None, use_cache=True):
     """
-    Извлекает текст из PDF-файла и возвращает его как строку.
-    
+    Извлекает текст PDF постранично; большие документы разбираются пулом процессов по диапазонам страниц.
+
     Args:
         file_path (str): Путь к PDF-файлу.
-        
+        page_range (tuple[int, int] | None): Полуинтервал страниц [start, stop), нумерация с нуля.
+        max_pages (int | None): Не больше стольких страниц.
+        workers (int | None): Размер пула процессов (по умолчанию COMIX_PDF_WORKERS); 1 — без пула.
+        use_cache (bool): Брать/класть результат в кэш по хэшу содержимого файла.
+
     Returns:
-        str: Извлечённый текст из PDF.
-        
-    Raises:
-        FileNotFoundError: Если файл не найден.
-        Exception: Если произошла ошибка при обработке PDF.
+        list[str]: Текст каждой страницы.
     """
     try:
+        cache = _get_cache() if use_cache else None
+        key = None
+        if cache is not None:
+            key = make_key('pdftext', file_hash(file_path), page_range, max_pages)
+            cached = cache.get(key)
+            if cached is not None:
+                return json.loads(cached[0].decode('utf-8'))
+
         with open(file_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text() or ""
-            return text
+            num_pages = len(PyPDF2.PdfReader(file).pages)
+        start, stop = _page_bounds(num_pages, page_range, max_pages)
+        count = stop - start
+
+        workers = workers or DEFAULT_WORKERS
+        if workers <= 1 or count < PARALLEL_MIN_PAGES:
+            pages = _extract_range(file_path, start, stop)
+        else:
+            step = -(-count // workers)
+            bounds = [(lo, min(lo + step, stop)) for lo in range(start, stop, step)]
+            # spawn, а не fork: в процессе бота работают потоки, HTTP-сессии и torch, и fork
+            # унёс бы в дочерний процесс чужие захваченные блокировки
+            with ProcessPoolExecutor(max_workers=len(bounds), mp_context=multiprocessing.get_context("spawn")) as pool:
+                chunks = pool.map(_extract_range, [file_path] * len(bounds), *zip(*bounds))
+                pages = [page for chunk in chunks for page in chunk]
+
+        if cache is not None:
+            cache.put(key, json.dumps(pages, ensure_ascii=False).encode('utf-8'), '.json')
+        return pages
     except FileNotFoundError:
         raise FileNotFoundError(f"Файл {file_path} не найден")
     except Exception as e:
-        raise Exception(f"Ошибка при обработке PDF: {str(e)}")
\ No newline at end of file
+        raise Exception(f"Ошибка при обработке PDF: {str(e)}")
+
+
+def extract_text_from_pdf(file_path, page_range=None, max_pages=None, workers=None, use_cache=True):
+    """
+    Извлекает текст из PDF-файла и возвращает его как строку.
+
+    Args:
+        file_path (str): Путь к PDF-файлу.
+        page_range (tuple[int, int] | None): Полуинтервал страниц [start, stop), нумерация с нуля.
+        max_pages (int | None): Не больше стольких страниц.
+        workers (int | None): Размер пула процессов для больших документов.
+        use_cache (bool): Использовать кэш по хэшу содержимого файла.
+
+    Returns:
+        str: Извлечённый текст из PDF.
+
+    Raises:
+        FileNotFoundError: Если файл не найден.
+        Exception: Если произошла ошибка при обработке PDF.
+    """
+    return "".join(extract_pages_from_pdf(file_path, page_range, max_pages, workers, use_cache))
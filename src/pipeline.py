@@ -1,122 +1,412 @@
 from __future__ import annotations
+import contextvars
 import os
 import tempfile
-from typing import Optional
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Iterator, Optional, Union
 
-from .pdftotext import extract_text_from_pdf
-from .scenparser import parse_scenario
-from .diffusion import generate_image
-from .yolo_detect import detect_faces
-from .addovals import add_speech_bubble
-from .imgcombine import combine_images_to_file
-from .actor_critic import generate_comix_actcrit
+from .pdftotext import extract_pages_from_pdf
+from .textprep import PrepReport, preprocess_pages
+from .scenparser import Scene, ScenarioStreamParser, repair_with_llm
+from .diffusion import placeholder_image
+from .imagebackend import get_image_backend
+from .yolo_detect import detect_faces_batch
+from .addovals import draw_speech_bubbles
+from .panel import Panel
+from .imgcombine import combine_images_to_file, write_page
+from .actor_critic import generate_comix_actcrit_stream, get_comic_system
+from .resilience import deadline_scope
+from .ratelimit import job_scope
 
+# Сколько запросов к диффузионке держим в полёте одновременно
+DEFAULT_IMAGE_WORKERS = int(os.getenv("COMIX_IMAGE_WORKERS", "4"))
 
-def generate_comic_from_pdf(pdf_path: str, output_path: Optional[str] = None) -> str:
-    """
-    Полный конвейер: PDF -> текст -> сценарий -> изображения сцен -> пузырьки речи -> финальная картинка.
+# Версия конвейера входит в ключ хранилища готовых комиксов (resultstore):
+# увеличивайте её при изменениях, после которых старые результаты не должны отдаваться
+PIPELINE_VERSION = "1"
 
-    Args:
-        pdf_path: путь к входному PDF
-        output_path: путь для сохранения результата (PNG). Если None, создаётся во временной папке.
+# Крайний срок (сек) на весь комикс: таймауты и повторы внешних API ужимаются под него; 0 — без срока
+DEFAULT_JOB_DEADLINE = float(os.getenv("COMIX_JOB_DEADLINE", "0"))
 
-    Returns:
-        Путь к итоговому файлу PNG.
-    """
-    if not os.path.isfile(pdf_path):
-        raise FileNotFoundError(f"Файл не найден: {pdf_path}")
 
-    # Извлечение текста
-    doctext = extract_text_from_pdf(pdf_path)
+# События потокового конвейера (см. iter_comic_from_pdf)
+
+@dataclass
+class TextExtracted:
+    """Текст документа извлечён из PDF и нормализован; report — что удалила нормализация."""
+    text: str
+    report: Optional[PrepReport] = None
 
-    # Генерация сценария (актор-критик) — без локальных фолбэков
-    scenario_text = generate_comix_actcrit(doctext)
 
-    # Парсинг сценария на сцены и реплики
-    scenario = parse_scenario(scenario_text)
-    # Валидация: если сцен нет — сообщаем об ошибке вызвавшей стороне (бот пошлёт дружелюбное сообщение)
-    if not scenario.get('scenes'):
-        raise RuntimeError("Сценарий пуст: парсер не нашёл ни одной сцены")
+@dataclass
+class ScenarioReady:
+    """Сценарий сгенерирован и разобран; scene_count — сколько сцен будет рендериться."""
+    scenario: dict
+    scene_count: int
 
-    charLdesc = scenario['charLdesc'][0] if scenario['charLdesc'] else None
-    charRdesc = scenario['charRdesc'][0] if scenario['charRdesc'] else None
 
-    scenelist: list[bytes] = []
+@dataclass
+class PanelRendered:
+    """Картинка сцены index (с нуля) готова, пузырьков с репликами на ней ещё нет."""
+    index: int
+    image: bytes
+
+
+@dataclass
+class PanelAnnotated:
+    """На панель index добавлены пузырьки с репликами (картинка в памяти, panel.to_bytes() — если нужны байты)."""
+    index: int
+    panel: Panel
+
+
+@dataclass
+class ComicReady:
+    """
+    Итоговая картинка комикса сохранена в path; в постраничном режиме pages — все страницы, path — первая.
+
+    degraded — хотя бы одна сцена не сгенерировалась и вместо неё стоит заглушка
+    (такой результат не стоит кэшировать надолго).
+    """
+    path: str
+    pages: list[str] = field(default_factory=list)
+    degraded: bool = False
+
 
-    def _sanitize_dialogue(s: Optional[str]) -> Optional[str]:
-        if s is None:
-            return None
-        # remove simple markdown emphasis to avoid **bold** etc.
-        for token in ("**", "*", "__", "_"):
-            s = s.replace(token, "")
-        return s.strip()
+PipelineEvent = Union[TextExtracted, ScenarioReady, PanelRendered, PanelAnnotated, ComicReady]
 
-    for i in range(len(scenario['scenes'])):
-        scenedesc = scenario['scenes'][i]
-        charLaction = scenario['charLaction'][i] if i < len(scenario['charLaction']) else None
-        charRaction = scenario['charRaction'][i] if i < len(scenario['charRaction']) else None
-        charLaction = _sanitize_dialogue(charLaction)
-        charRaction = _sanitize_dialogue(charRaction)
 
-        sceneprompt = f"""
+def _sanitize_dialogue(s: Optional[str]) -> Optional[str]:
+    if s is None:
+        return None
+    # remove simple markdown emphasis to avoid **bold** etc.
+    for token in ("**", "*", "__", "_"):
+        s = s.replace(token, "")
+    return s.strip()
+
+
+def _build_scene_prompt(
+    scenedesc: Optional[str],
+    charLaction: Optional[str],
+    charRaction: Optional[str],
+    charLdesc: Optional[str],
+    charRdesc: Optional[str],
+) -> str:
+    sceneprompt = f"""
 {scenedesc}
 It's a part of comic book with characters in the comix style, draw full-length characters.
 The characters should be cartoony, 2D, suitable for a comic, and not overly complex and not overly expressive.
 """
-        if charLaction is not None and charLdesc:
-            sceneprompt += 'Appearance of left character:\n' + charLdesc + '\n'
-        
-        if charRaction is not None and charRdesc:
-            sceneprompt += 'Appearance of right character:\n' + charRdesc + '\n'
+    if charLaction is not None and charLdesc:
+        sceneprompt += 'Appearance of left character:\n' + charLdesc + '\n'
+
+    if charRaction is not None and charRdesc:
+        sceneprompt += 'Appearance of right character:\n' + charRdesc + '\n'
+
+    sceneprompt += 'location is absent of people'
+    return sceneprompt
+
+
+def _annotate_panel(panel: Panel, faces: list, charLaction: Optional[str], charRaction: Optional[str]) -> None:
+    """Рисует на панели пузырьки с репликами у найденных лиц (левая реплика — у самого левого лица)."""
+    left = True
+
+    # Сортировка лиц слева-направо, если два лица
+    if len(faces) == 2 and faces[0][0] > faces[1][0]:
+        face = faces[0]
+        faces[0] = faces[1]
+        faces[1] = face
+
+    bubbles = []
+    for x, y in faces:
+        if left and charLaction is not None:
+            bubbles.append((charLaction, x, y))
+            left = False
+        elif charRaction is not None:
+            bubbles.append((charRaction, x, y))
+    # Все пузыри панели рисуются за один проход с совместной раскладкой
+    draw_speech_bubbles(panel.image, bubbles, max_bubble_width=280, min_font_size=8)
+
+
+def _render_scene(index: int, sceneprompt: str) -> tuple[bytes, bool]:
+    """Генерирует одну сцену выбранным бэкендом; ошибка изолирована в пределах сцены. Возвращает (картинка, заглушка ли)."""
+    backend = get_image_backend()
+    # Генерация изображения сцены с перехватом ошибок (фиксированный размер для стабильной вёрстки)
+    try:
+        img_bytes, _ext = backend.generate(sceneprompt, 832, 512)
+        return img_bytes, False
+    except Exception as e:
+        # Все бэкенды отказали — как и раньше, вместо дыры в комиксе ставим заглушку
+        print(f"[pipeline] Не удалось сгенерировать сцену {index+1} ({backend.name}): {e}")
+        return placeholder_image(sceneprompt), True
+
+
+def _render_batch(jobs: list[tuple[int, str]], results: dict[int, Future]) -> None:
+    """
+    Генерирует пакет сцен (номер, промпт) одним вызовом бэкенда; results[номер] получает то же,
+    что вернул бы _render_scene. Неудавшиеся сцены, как и там, заменяются заглушкой.
+    """
+    backend = get_image_backend()
+    try:
+        for j, img_bytes, _ext in backend.generate_batch([prompt for _i, prompt in jobs], 832, 512):
+            index, sceneprompt = jobs[j]
+            if img_bytes is None:
+                print(f"[pipeline] Не удалось сгенерировать сцену {index+1} ({backend.name})")
+                results[index].set_result((placeholder_image(sceneprompt), True))
+            else:
+                results[index].set_result((img_bytes, False))
+    except Exception as e:
+        print(f"[pipeline] Пакет из {len(jobs)} сцен прерван ({backend.name}): {e}")
+    finally:
+        for index, sceneprompt in jobs:
+            if not results[index].done():
+                results[index].set_result((placeholder_image(sceneprompt), True))
+
+
+def iter_comic_from_pdf(
+    pdf_path: str,
+    output_path: Optional[str] = None,
+    image_workers: Optional[int] = None,
+    output_format: str = 'PNG',
+    quality: int = 85,
+    max_side: Optional[int] = None,
+    panels_per_page: Optional[int] = None,
+    deadline: Optional[float] = None,
+) -> Iterator[PipelineEvent]:
+    """
+    Потоковый вариант конвейера: отдаёт события по мере готовности этапов.
+
+    Порядок событий: TextExtracted, ScenarioReady, PanelRendered (в порядке завершения рендера,
+    не по номеру сцены), PanelAnnotated (по номеру сцены), ComicReady. Сцена, которую не смог
+    нарисовать ни один бэкенд, заменяется заглушкой и проходит все этапы как обычная
+    (ComicReady.degraded=True). Рендер сцен начинается ещё во время
+    генерации сценария, по мере того как LLM дописывает очередную сцену; бэкенду с пакетным
+    API (prefers_batch) все сцены уходят одним пакетом после сценария.
+
+    Args:
+        pdf_path: путь к входному PDF
+        output_path: путь для сохранения результата. Если None, создаётся во временной папке.
+        image_workers: максимум одновременных запросов генерации сцен (по умолчанию COMIX_IMAGE_WORKERS или 4)
+        output_format: формат итогового файла (PNG, JPEG, WEBP) — пишется сразу в нём, без промежуточного PNG
+        quality: качество для JPEG/WEBP
+        max_side: ограничение на большую сторону итоговой картинки (страницы); панели уменьшаются при вставке
+        panels_per_page: если задано, комикс пишется страницами по столько панелей (файлы <output>_pN.<ext>)
+        deadline: крайний срок на весь комикс в секундах (по умолчанию COMIX_JOB_DEADLINE; 0/None — без срока)
+    """
+    # Крайний срок и id задачи живут в contextvars. Генератор выполняется в контексте того, кто зовёт next(),
+    # поэтому каждый шаг конвейера (и его закрытие) прогоняем в собственной копии контекста: значения
+    # не утекают к вызывающему между yield и сбрасываются там же, где были установлены.
+    context = contextvars.copy_context()
+    events = _iter_comic_scoped(
+        pdf_path, output_path, image_workers, output_format, quality, max_side, panels_per_page,
+        deadline if deadline is not None else DEFAULT_JOB_DEADLINE,
+    )
+    try:
+        while True:
+            try:
+                event = context.run(next, events)
+            except StopIteration:
+                return
+            yield event
+    finally:
+        context.run(events.close)
+
+
+def _iter_comic_scoped(
+    pdf_path: str,
+    output_path: Optional[str],
+    image_workers: Optional[int],
+    output_format: str,
+    quality: int,
+    max_side: Optional[int],
+    panels_per_page: Optional[int],
+    deadline: Optional[float],
+) -> Iterator[PipelineEvent]:
+    # job_scope: запросы к LLM этого комикса планировщик чередует с запросами других комиксов
+    with deadline_scope(deadline), job_scope(uuid.uuid4().hex):
+        yield from _iter_comic(pdf_path, output_path, image_workers, output_format, quality, max_side, panels_per_page)
+
+
+def _iter_comic(
+    pdf_path: str,
+    output_path: Optional[str],
+    image_workers: Optional[int],
+    output_format: str,
+    quality: int,
+    max_side: Optional[int],
+    panels_per_page: Optional[int],
+) -> Iterator[PipelineEvent]:
+    if not os.path.isfile(pdf_path):
+        raise FileNotFoundError(f"Файл не найден: {pdf_path}")
+
+    # Извлечение текста и его нормализация (колонтитулы, переносы, пробелы).
+    # Бюджет токенов здесь не применяем: длинный документ сначала сжимается суммаризацией,
+    # а обрезка по бюджету делается уже над выжимкой (ComicGenerationSystem.iter_actor_critic)
+    doctext, prep_report = preprocess_pages(extract_pages_from_pdf(pdf_path), token_budget=0)
+    print(
+        f"[pipeline] Нормализация текста: {prep_report.tokens_before} -> {prep_report.tokens_after} токенов"
+        f" (-{prep_report.removed_fraction:.0%})"
+    )
+    if not doctext:
+        raise RuntimeError("Не удалось извлечь текст из PDF (возможно, это скан без текстового слоя)")
+    yield TextExtracted(doctext, prep_report)
+
+    # номер сцены -> (промпт сцены, реплика слева, реплика справа); отложенные сцены рендерятся не по порядку
+    scene_jobs: dict[int, tuple[str, Optional[str], Optional[str]]] = {}
+    images: dict[int, bytes] = {}
+    # сцены, вместо которых встала заглушка
+    placeholders: set[int] = set()
+    futures = {}
+    parser = ScenarioStreamParser()
+    # сцены, которые рендерятся одним пакетом после сценария: ждущие дозапроса к LLM (пустое описание
+    # или пока нет описаний персонажей) и, если бэкенду выгоднее пакеты (prefers_batch), — все
+    deferred: list[Scene] = []
+    batch_all = get_image_backend().prefers_batch
+
+    workers = max(1, image_workers or DEFAULT_IMAGE_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scene") as pool:
+
+        def submit(scene: Scene) -> None:
+            if batch_all or scene.description is None or parser.charLdesc is None or parser.charRdesc is None:
+                deferred.append(scene)
+                return
+            sceneprompt = prepare(scene)
+            # copy_context переносит крайний срок задачи в поток рендера
+            futures[pool.submit(contextvars.copy_context().run, _render_scene, scene.index, sceneprompt)] = scene.index
+
+        def prepare(scene: Scene) -> str:
+            charLaction = _sanitize_dialogue(scene.charLaction)
+            charRaction = _sanitize_dialogue(scene.charRaction)
+            sceneprompt = _build_scene_prompt(
+                scene.description, charLaction, charRaction, parser.charLdesc, parser.charRdesc
+            )
+            scene_jobs[scene.index] = (sceneprompt, charLaction, charRaction)
+            return sceneprompt
 
-        sceneprompt += 'location is absent of people'
+        def render_batch(scenes: list[Scene]) -> None:
+            jobs = [(scene.index, prepare(scene)) for scene in scenes]
+            results = {index: Future() for index, _prompt in jobs}
+            for index, future in results.items():
+                futures[future] = index
+            pool.submit(contextvars.copy_context().run, _render_batch, jobs, results)
 
-        # Генерация изображения сцены с перехватом ошибок (фиксированный размер для стабильной вёрстки)
         try:
-            img_bytes, _ext = generate_image(sceneprompt, width=832, height=512)
-        except Exception as e:
-            print(f"[pipeline] Не удалось сгенерировать сцену {i+1}: {e}")
-            continue
-
-        # Детекция лиц и добавление "облачков" с репликами
-        faces = detect_faces(img_bytes)
-        left = True
-
-        # Сортировка лиц слева-направо, если два лица
-        if len(faces) == 2 and faces[0][0] > faces[1][0]:
-            face = faces[0]
-            faces[0] = faces[1]
-            faces[1] = face
-
-        for x, y in faces:
-            if left and charLaction is not None:
-                img_bytes = add_speech_bubble(
-                    img_bytes,
-                    charLaction,
-                    x,
-                    y,
-                    max_bubble_width=280,
-                    min_font_size=8,
-                )
-                left = False
-            elif charRaction is not None:
-                img_bytes = add_speech_bubble(
-                    img_bytes,
-                    charRaction,
-                    x,
-                    y,
-                    max_bubble_width=280,
-                    min_font_size=8,
-                )
-        scenelist.append(img_bytes)
+            # Генерация сценария (актор-критик) — без локальных фолбэков.
+            # Итоговый черновик приходит потоком: каждую законченную сцену сразу отправляем на рендер,
+            # пока модель ещё дописывает следующие.
+            for delta in generate_comix_actcrit_stream(doctext):
+                for scene in parser.feed(delta):
+                    submit(scene)
+            for scene in parser.finish():
+                submit(scene)
+
+            for issue in parser.issues:
+                print(f"[pipeline] Сценарий, строка {issue.line}: {issue.message}"
+                      f"{'' if issue.repaired else ' (не исправлено)'}")
+            # Чего не починить локально — точечно дозапрашиваем у LLM, а не перегенерируем сценарий
+            if parser.unrepaired and parser.scenes:
+                system = get_comic_system()
+                repair_with_llm(parser, lambda prompt: system.generate_text(prompt, role="repair"))
+            if deferred:
+                render_batch(deferred)
+        except BaseException:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+        scenario = parser.result()
+        # Валидация: если сцен нет — сообщаем об ошибке вызвавшей стороне (бот пошлёт дружелюбное сообщение)
+        if not scenario.get('scenes'):
+            raise RuntimeError("Сценарий пуст: парсер не нашёл ни одной сцены")
+
+        yield ScenarioReady(scenario, len(scene_jobs))
+
+        # Сцены рендерятся параллельно; каждую отдаём сразу, как только она готова
+        for future in as_completed(futures):
+            i = futures[future]
+            images[i], placeholder = future.result()
+            if placeholder:
+                placeholders.add(i)
+            yield PanelRendered(i, images[i])
 
     # Куда сохраняем результат
     if output_path is None:
         tmpdir = tempfile.mkdtemp(prefix="comix_")
-        output_path = os.path.join(tmpdir, "comic.png")
+        ext = {'JPEG': '.jpg', 'WEBP': '.webp'}.get(output_format.upper(), '.png')
+        output_path = os.path.join(tmpdir, "comic" + ext)
+
+    # (номер сцены, реплика слева, реплика справа) — до склейки сцены хранятся закодированными.
+    # Картинка есть у каждой сцены (в худшем случае заглушка), а пустой сценарий отсечён выше.
+    rendered = [(i, charLaction, charRaction) for i, (_prompt, charLaction, charRaction) in sorted(scene_jobs.items())]
+
+    # Постранично: декодирование, детекция лиц (одним батчем на страницу), пузырьки и склейка
+    # делаются для панелей одной страницы, после записи страницы панели отпускаются —
+    # в памяти одновременно живут декодированные панели только текущей страницы.
+    # Одна итоговая картинка содержит все панели сразу, поэтому там «страница» — весь комикс.
+    group = panels_per_page or len(rendered)
+    pages: list[str] = []
+    scenelist: list[Panel] = []
+    for start in range(0, len(rendered), group):
+        chunk = rendered[start:start + group]
+        panels = [Panel.from_bytes(images.pop(i)) for i, _l, _r in chunk]
+        faces_per_scene = detect_faces_batch([panel.array for panel in panels])
+        for (i, charLaction, charRaction), panel, faces in zip(chunk, panels, faces_per_scene):
+            _annotate_panel(panel, faces, charLaction, charRaction)
+            yield PanelAnnotated(i, panel)
+        if panels_per_page:
+            pages.append(write_page(
+                panels, output_path, len(pages) + 1, format=output_format, quality=quality, max_side=max_side
+            ))
+        else:
+            scenelist.extend(panels)
+        del panels
+
+    if panels_per_page:
+        yield ComicReady(pages[0], pages, degraded=bool(placeholders))
+        return
+
+    combine_images_to_file(scenelist, output_path, format=output_format, quality=quality, max_side=max_side)
+    yield ComicReady(output_path, [output_path], degraded=bool(placeholders))
 
-    if not scenelist:
-        raise RuntimeError("Не удалось сгенерировать ни одной сцены комикса. Попробуйте ещё раз или другой документ.")
 
-    combine_images_to_file(scenelist, output_path)
-    return output_path
+def generate_comic_from_pdf(
+    pdf_path: str,
+    output_path: Optional[str] = None,
+    image_workers: Optional[int] = None,
+    output_format: str = 'PNG',
+    quality: int = 85,
+    max_side: Optional[int] = None,
+    panels_per_page: Optional[int] = None,
+    deadline: Optional[float] = None,
+) -> str:
+    """
+    Полный конвейер: PDF -> текст -> сценарий -> изображения сцен -> пузырьки речи -> финальная картинка.
+
+    Args:
+        pdf_path: путь к входному PDF
+        output_path: путь для сохранения результата. Если None, создаётся во временной папке.
+        image_workers: максимум одновременных запросов генерации сцен (по умолчанию COMIX_IMAGE_WORKERS или 4)
+        output_format: формат итогового файла (PNG, JPEG, WEBP) — пишется сразу в нём, без промежуточного PNG
+        quality: качество для JPEG/WEBP
+        max_side: ограничение на большую сторону итоговой картинки (страницы); панели уменьшаются при вставке
+        panels_per_page: если задано, комикс пишется страницами по столько панелей (файлы <output>_pN.<ext>)
+        deadline: крайний срок на весь комикс в секундах (по умолчанию COMIX_JOB_DEADLINE; 0/None — без срока)
+
+    Returns:
+        Путь к итоговому файлу (в постраничном режиме — к первой странице; все страницы есть в ComicReady.pages).
+    """
+    result = None
+    events = iter_comic_from_pdf(
+        pdf_path,
+        output_path,
+        image_workers=image_workers,
+        output_format=output_format,
+        quality=quality,
+        max_side=max_side,
+        panels_per_page=panels_per_page,
+        deadline=deadline,
+    )
+    for event in events:
+        if isinstance(event, ComicReady):
+            result = event.path
+    return result
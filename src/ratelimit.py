@@ -0,0 +1,263 @@
+from __future__ import annotations
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Hashable, Optional
+
+from .resilience import DeadlineExceeded, current_deadline
+
+# Лимиты OpenRouter для общего ключа: запросов в минуту, одновременных запросов и размер «пачки»
+LLM_RPM = float(os.getenv("COMIX_LLM_RPM", "20"))
+LLM_CONCURRENCY = int(os.getenv("COMIX_LLM_CONCURRENCY", "4"))
+LLM_BURST = float(os.getenv("COMIX_LLM_BURST", "5"))
+# Путь к SQLite-файлу — лимит RPM и Retry-After общие для всех процессов бота на машине
+LLM_RATE_DB = os.getenv("COMIX_LLM_RATE_DB") or None
+# Пауза после 429, если сервер не прислал Retry-After
+DEFAULT_RETRY_AFTER = 10.0
+
+
+_current_job: contextvars.ContextVar[Optional[Hashable]] = contextvars.ContextVar("comix_job", default=None)
+
+
+@contextmanager
+def job_scope(job_id: Hashable):
+    """Все вызовы LLM внутри блока планировщик относит к задаче job_id (очередь честная между задачами)."""
+    token = _current_job.set(job_id)
+    try:
+        yield job_id
+    finally:
+        _current_job.reset(token)
+
+
+def _check_rate(rate_per_minute: float) -> float:
+    if not rate_per_minute > 0:
+        raise ValueError(f"Лимит запросов в минуту должен быть больше нуля, получено {rate_per_minute!r}")
+    return rate_per_minute / 60.0
+
+
+class MemoryBucket:
+    """Token bucket в памяти процесса."""
+
+    def __init__(self, rate_per_minute: float, burst: float):
+        self.rate = _check_rate(rate_per_minute)
+        self.capacity = max(1.0, burst)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def try_take(self) -> float:
+        """Берёт токен и возвращает 0, либо возвращает, сколько секунд ждать следующего."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return 0.0
+            return (1.0 - self._tokens) / self.rate
+
+    def block(self, seconds: float) -> None:
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class SQLiteBucket:
+    """
+    Token bucket в SQLite-файле: общий для всех процессов, открывших тот же путь.
+
+    Каждая попытка — короткая транзакция BEGIN IMMEDIATE (файловая блокировка SQLite),
+    время — настенные часы, потому что monotonic у процессов разный.
+    """
+
+    def __init__(self, path: str, rate_per_minute: float, burst: float, name: str = "openrouter"):
+        self.path = path
+        self.name = name
+        self.rate = _check_rate(rate_per_minute)
+        self.capacity = max(1.0, burst)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "name TEXT PRIMARY KEY, tokens REAL, updated REAL, blocked_until REAL)"
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO buckets VALUES (?, ?, ?, 0)", (name, self.capacity, time.time())
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def try_take(self) -> float:
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            tokens, updated, blocked_until = conn.execute(
+                "SELECT tokens, updated, blocked_until FROM buckets WHERE name = ?", (self.name,)
+            ).fetchone()
+            now = time.time()
+            if now < blocked_until:
+                conn.execute("COMMIT")
+                return blocked_until - now
+            tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= 1.0:
+                tokens -= 1.0
+            else:
+                wait = (1.0 - tokens) / self.rate
+            conn.execute("UPDATE buckets SET tokens = ?, updated = ? WHERE name = ?", (tokens, now, self.name))
+            conn.execute("COMMIT")
+            return wait
+        finally:
+            conn.close()
+
+    def block(self, seconds: float) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE buckets SET blocked_until = MAX(blocked_until, ?) WHERE name = ?",
+                (time.time() + seconds, self.name),
+            )
+
+
+class LLMScheduler:
+    """
+    Планировщик запросов к LLM: лимит запросов в минуту (token bucket), лимит одновременных
+    запросов и честная очередь между задачами.
+
+    Ожидающие запросы сгруппированы по задачам (job_scope); слот выдаётся задачам по кругу,
+    поэтому длинный документ с десятком суммаризаций не задерживает короткий комикс соседа.
+    После 429 (penalize) новые запросы не выдаются Retry-After секунд. Ожидание в очереди
+    ограничено крайним сроком задачи (resilience.deadline_scope).
+
+    При bucket=SQLiteBucket лимит RPM и пауза после 429 общие для процессов; лимит
+    одновременных запросов всегда действует в пределах процесса.
+    """
+
+    def __init__(self, bucket, max_concurrent: int = LLM_CONCURRENCY):
+        self.bucket = bucket
+        self.max_concurrent = max(1, max_concurrent)
+        self._cond = threading.Condition()
+        self._queues: dict = {}
+        self._rotation: deque = deque()
+        self._active = 0
+        self._counters = {'granted': 0, 'penalties': 0, 'deadline_exceeded': 0}
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _my_turn(self, job, ticket) -> bool:
+        return self._rotation[0] == job and self._queues[job][0] is ticket and self._active < self.max_concurrent
+
+    def _dequeue(self, job, ticket) -> None:
+        queue = self._queues[job]
+        queue.remove(ticket)
+        self._rotation.remove(job)
+        if queue:
+            # у задачи ещё есть запросы — она встаёт в конец круга
+            self._rotation.append(job)
+        else:
+            del self._queues[job]
+
+    def _wait(self, deadline, timeout: Optional[float]) -> None:
+        """Ждёт уведомления не дольше timeout и крайнего срока задачи (вызывается под self._cond)."""
+        if deadline is not None:
+            left = deadline.remaining()
+            if left <= 0:
+                self._counters['deadline_exceeded'] += 1
+                raise DeadlineExceeded("Время на задачу истекло в очереди к LLM")
+            timeout = left if timeout is None else min(timeout, left)
+        self._cond.wait(timeout)
+
+    def acquire(self) -> None:
+        """Ждёт своей очереди, свободного слота и токена; парный вызов — release()."""
+        job = _current_job.get()
+        if job is None:
+            job = ("thread", threading.get_ident())
+        deadline = current_deadline()
+        ticket = object()
+        started = time.monotonic()
+        with self._cond:
+            if job not in self._queues:
+                self._queues[job] = deque()
+                self._rotation.append(job)
+            self._queues[job].append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    while not self._my_turn(job, ticket):
+                        self._wait(deadline, None)
+                # Токен берём без блокировки планировщика: у SQLiteBucket это транзакция BEGIN IMMEDIATE
+                # с ожиданием файловой блокировки, и release/penalize/stats не должны стоять за ней.
+                # Пробует только голова очереди, а снять её с головы может лишь она сама.
+                wait = self.bucket.try_take()
+                with self._cond:
+                    if wait <= 0:
+                        self._dequeue(job, ticket)
+                        self._active += 1
+                        waited = time.monotonic() - started
+                        self._counters['granted'] += 1
+                        self._total_wait += waited
+                        self._max_wait = max(self._max_wait, waited)
+                        self._cond.notify_all()
+                        return
+                    self._wait(deadline, wait)
+        except BaseException:
+            with self._cond:
+                self._dequeue(job, ticket)
+                self._cond.notify_all()
+            raise
+
+    def release(self) -> None:
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def penalize(self, retry_after: Optional[float]) -> None:
+        """Сервер ответил 429: приостанавливаем выдачу слотов на Retry-After секунд."""
+        seconds = retry_after if retry_after is not None else DEFAULT_RETRY_AFTER
+        self.bucket.block(seconds)
+        with self._cond:
+            self._counters['penalties'] += 1
+            self._cond.notify_all()
+        print(f"[llm] 429 от OpenRouter, пауза {seconds:.1f} с для всех задач")
+
+    def stats(self) -> dict:
+        with self._cond:
+            granted = self._counters['granted']
+            return dict(
+                self._counters,
+                active=self._active,
+                queued=sum(len(q) for q in self._queues.values()),
+                avg_wait=self._total_wait / granted if granted else 0.0,
+                max_wait=self._max_wait,
+            )
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_llm_scheduler() -> LLMScheduler:
+    """Общий на процесс планировщик запросов к OpenRouter (COMIX_LLM_RPM/CONCURRENCY/BURST/RATE_DB)."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            if LLM_RATE_DB:
+                bucket = SQLiteBucket(LLM_RATE_DB, LLM_RPM, LLM_BURST)
+            else:
+                bucket = MemoryBucket(LLM_RPM, LLM_BURST)
+            _scheduler = LLMScheduler(bucket, LLM_CONCURRENCY)
+    return _scheduler
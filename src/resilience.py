@@ -0,0 +1,327 @@
+from __future__ import annotations
+import contextvars
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional, Union
+
+Timeout = Union[float, tuple]
+
+# Предохранитель размыкается после стольких ошибок подряд и ждёт столько секунд до пробного вызова
+BREAKER_THRESHOLD = int(os.getenv("COMIX_BREAKER_THRESHOLD", "5"))
+BREAKER_RESET = float(os.getenv("COMIX_BREAKER_RESET", "30"))
+
+
+class DeadlineExceeded(Exception):
+    """Время на задачу вышло — новые попытки не делаются."""
+
+
+class CircuitOpen(Exception):
+    """Бэкенд признан недоступным, вызов отклонён без обращения к сети."""
+
+
+class RetryableHTTPError(Exception):
+    """HTTP-ответ, который имеет смысл повторить (429/5xx)."""
+
+    def __init__(self, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(f"HTTP ошибка: {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class ClientHTTPError(Exception):
+    """HTTP-ответ 4xx (кроме 429): бэкенд жив и ответил, ошибка в самом запросе — повторять бессмысленно."""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP ошибка: {status_code}")
+        self.status_code = status_code
+
+
+class Deadline:
+    """Крайний срок задачи: из него выводятся таймауты отдельных вызовов."""
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def clamp(self, timeout: Timeout) -> Timeout:
+        """Ужимает таймаут вызова (число или (connect, read)) до оставшегося времени."""
+        left = self.remaining()
+        if left <= 0:
+            raise DeadlineExceeded("Время на задачу истекло")
+        if isinstance(timeout, tuple):
+            return tuple(min(t, left) for t in timeout)
+        return min(timeout, left)
+
+
+_current_deadline: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("comix_deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float]):
+    """
+    Задаёт крайний срок для всех вызовов внешних API внутри блока (None/0 — без срока).
+
+    Срок хранится в contextvar; в пулы потоков он передаётся через
+    contextvars.copy_context().run при submit. Внутри генератора блок должен
+    входить и выходить в одном контексте (см. pipeline.iter_comic_from_pdf).
+    """
+    if not seconds:
+        yield None
+        return
+    deadline = Deadline(seconds)
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+class CircuitBreaker:
+    """
+    Предохранитель бэкенда: после failure_threshold ошибок подряд размыкается и
+    reset_timeout секунд сразу отклоняет вызовы (CircuitOpen). Затем пропускает
+    один пробный вызов: успех замыкает цепь, ошибка — снова размыкает.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_THRESHOLD, reset_timeout: float = BREAKER_RESET):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._counters = {'calls': 0, 'successes': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def allow(self) -> None:
+        """Пропускает вызов или бросает CircuitOpen."""
+        with self._lock:
+            if self._state == "open":
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self._counters['rejected'] += 1
+                    raise CircuitOpen(f"Бэкенд {self.name} временно недоступен")
+                self._state = "half_open"
+                self._probe_in_flight = False
+            if self._state == "half_open":
+                if self._probe_in_flight:
+                    self._counters['rejected'] += 1
+                    raise CircuitOpen(f"Бэкенд {self.name} проверяется, повторите позже")
+                self._probe_in_flight = True
+            self._counters['calls'] += 1
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._counters['successes'] += 1
+            self._consecutive_failures = 0
+            self._state = "closed"
+            self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """Вызов кончился без ответа бэкенда: состояние не меняем, но пропустим следующий пробный вызов."""
+        with self._lock:
+            if self._state == "half_open":
+                self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._counters['failures'] += 1
+            self._consecutive_failures += 1
+            if self._state == "half_open" or self._consecutive_failures >= self.failure_threshold:
+                if self._state != "open":
+                    self._counters['opened'] += 1
+                self._state = "open"
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counters, state=self._state, consecutive_failures=self._consecutive_failures)
+
+
+class RetryPolicy:
+    """
+    Повторы с экспоненциальной паузой и полным джиттером, с учётом крайнего срока задачи.
+
+    call(fn) вызывает fn(timeout), где timeout — базовый таймаут, ужатый до оставшегося
+    времени. Повторяются только ошибки, для которых retryable(exc) истинно; пауза
+    не выходит за крайний срок, а Retry-After сервера (если есть) берётся как минимум.
+    """
+
+    def __init__(
+        self,
+        attempts: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 10.0,
+        timeout: Timeout = 60.0,
+        retryable: Optional[Callable[[BaseException], bool]] = None,
+    ):
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.retryable = retryable or (lambda exc: True)
+        self._lock = threading.Lock()
+        self._counters = {'calls': 0, 'retries': 0, 'gave_up': 0, 'deadline_exceeded': 0}
+
+    def backoff(self, attempt: int) -> float:
+        """Пауза перед попыткой attempt+1: случайная в [0, min(max_delay, base * 2^(attempt-1))]."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def call(self, fn: Callable[[Timeout], object], breaker: Optional[CircuitBreaker] = None):
+        self._count('calls')
+        deadline = current_deadline()
+        for attempt in range(1, self.attempts + 1):
+            try:
+                timeout = deadline.clamp(self.timeout) if deadline is not None else self.timeout
+            except DeadlineExceeded:
+                self._count('deadline_exceeded')
+                raise
+            if breaker is not None:
+                breaker.allow()
+            try:
+                result = fn(timeout)
+            except Exception as e:
+                retryable = self.retryable(e)
+                if breaker is not None:
+                    # Ответ 4xx (кроме 429) — бэкенд жив, ошибка в запросе. Прочие неповторяемые ошибки
+                    # (крайний срок, разомкнутый предохранитель, баги разбора ответа) о бэкенде ничего
+                    # не говорят и предохранитель не трогают: иначе полуоткрытый замкнулся бы без ответа сервера
+                    if retryable:
+                        breaker.record_failure()
+                    elif is_client_error(e):
+                        breaker.record_success()
+                    else:
+                        breaker.release_probe()
+                if not retryable or attempt == self.attempts:
+                    self._count('gave_up')
+                    raise
+                pause = max(self.backoff(attempt), retry_after_of(e) or 0.0)
+                if deadline is not None and pause >= deadline.remaining():
+                    self._count('deadline_exceeded')
+                    raise DeadlineExceeded("Не осталось времени на повтор") from e
+                self._count('retries')
+                time.sleep(pause)
+                continue
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+
+def is_retryable_http(exc: BaseException) -> bool:
+    """Сетевые сбои, таймауты и 429/5xx повторяем; прочие HTTP-ошибки и ошибки кода — нет."""
+    if isinstance(exc, RetryableHTTPError):
+        return True
+    try:
+        import requests
+    except Exception:
+        return False
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+
+def is_retryable_openai(exc: BaseException) -> bool:
+    """429, 5xx, таймауты и обрывы соединения OpenRouter повторяем; 401/404 и т. п. — нет."""
+    try:
+        from openai import APIConnectionError, APIStatusError, RateLimitError
+    except Exception:
+        return False
+    if isinstance(exc, (RateLimitError, APIConnectionError)):  # APITimeoutError — подкласс APIConnectionError
+        return True
+    return isinstance(exc, APIStatusError) and exc.status_code >= 500
+
+
+def is_client_error(exc: BaseException) -> bool:
+    """Настоящий ответ сервера 4xx, кроме 429 (ClientHTTPError или APIStatusError OpenAI)."""
+    if isinstance(exc, ClientHTTPError):
+        return True
+    try:
+        from openai import APIStatusError
+    except Exception:
+        return False
+    return isinstance(exc, APIStatusError) and 400 <= exc.status_code < 500 and exc.status_code != 429
+
+
+def parse_retry_after(value) -> Optional[float]:
+    """Значение заголовка Retry-After в секундах (поддерживается только числовая форма)."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after_of(exc: BaseException) -> Optional[float]:
+    """Сколько сервер просил подождать: из RetryableHTTPError или заголовка ответа ошибки OpenAI."""
+    retry_after = getattr(exc, 'retry_after', None)
+    if retry_after is not None:
+        return retry_after
+    response = getattr(exc, 'response', None)
+    headers = getattr(response, 'headers', None)
+    return parse_retry_after(headers.get("Retry-After")) if headers is not None else None
+
+
+def check_http_response(resp):
+    """Бросает RetryableHTTPError для 429/5xx; остальные ответы возвращает как есть."""
+    if resp.status_code == 429 or resp.status_code >= 500:
+        raise RetryableHTTPError(resp.status_code, parse_retry_after(resp.headers.get("Retry-After")))
+    return resp
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_policies: dict[str, RetryPolicy] = {}
+_registry_lock = threading.Lock()
+
+
+def get_breaker(name: str, failure_threshold: int = BREAKER_THRESHOLD, reset_timeout: float = BREAKER_RESET) -> CircuitBreaker:
+    """Общий на процесс предохранитель бэкенда name (параметры учитываются при первом создании)."""
+    with _registry_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, failure_threshold, reset_timeout)
+        return _breakers[name]
+
+
+def get_retry_policy(name: str, **kwargs) -> RetryPolicy:
+    """Общая на процесс политика повторов бэкенда name (kwargs — как у RetryPolicy, учитываются при первом создании)."""
+    with _registry_lock:
+        if name not in _policies:
+            _policies[name] = RetryPolicy(**kwargs)
+        return _policies[name]
+
+
+def resilience_stats() -> dict:
+    """Счётчики по бэкендам: {имя: {'breaker': {state, calls, failures, rejected, ...}, 'retry': {...}}}."""
+    with _registry_lock:
+        names = set(_breakers) | set(_policies)
+        breakers, policies = dict(_breakers), dict(_policies)
+    return {
+        name: {
+            'breaker': breakers[name].stats() if name in breakers else None,
+            'retry': policies[name].stats() if name in policies else None,
+        }
+        for name in sorted(names)
+    }
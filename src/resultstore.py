@@ -0,0 +1,211 @@
+from __future__ import annotations
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from .diskcache import make_key
+
+# Хранилище готовых комиксов: COMIX_RESULT_STORE=0 отключает его целиком
+STORE_ENABLED = os.getenv("COMIX_RESULT_STORE", "1") != "0"
+STORE_DIR = os.getenv("COMIX_RESULT_STORE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "doc2comix", "results"))
+STORE_MAX_ENTRIES = int(os.getenv("COMIX_RESULT_STORE_SIZE", "200"))
+# Срок жизни записи (сек) от момента создания: потом комикс генерируется заново; 0 — бессрочно
+STORE_TTL = float(os.getenv("COMIX_RESULT_STORE_TTL", str(7 * 24 * 3600)))
+
+_store = None
+_store_lock = threading.Lock()
+
+
+@dataclass
+class StoredComic:
+    """Готовый комикс из хранилища: файлы страниц и, если уже отправляли, их file_id в Telegram."""
+    key: str
+    pages: list[str]
+    file_ids: list[Optional[str]] = field(default_factory=list)
+
+
+class ResultStore:
+    """
+    Хранилище готовых комиксов по хэшу содержимого PDF (плюс версия конвейера и параметры вывода).
+
+    Запись — каталог <dir>/<key>/ со страницами и manifest.json. Каталог собирается
+    во временном месте и переименовывается целиком, поэтому другие процессы видят
+    либо полную запись, либо никакую. Старые записи (по времени последнего
+    обращения) удаляются, когда их больше max_entries; записи старше ttl секунд
+    (от создания) не отдаются и удаляются.
+    """
+
+    def __init__(self, directory: str, max_entries: int = 200, ttl: float = 0):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'writes': 0, 'expired': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(pdf_hash: str, pipeline_version: str, **options) -> str:
+        return make_key('comic', pdf_hash, pipeline_version, options)
+
+    def _manifest_path(self, key: str) -> str:
+        return os.path.join(self.directory, key, 'manifest.json')
+
+    def _expired(self, manifest: dict) -> bool:
+        return bool(self.ttl) and time.time() - manifest.get('created', 0) > self.ttl
+
+    def _entry_expired(self, entry_dir: str) -> bool:
+        try:
+            with open(os.path.join(entry_dir, 'manifest.json'), 'r', encoding='utf-8') as f:
+                return self._expired(json.load(f))
+        except (OSError, ValueError):
+            # битую запись оставляем обычному вытеснению по времени обращения
+            return False
+
+    def _remove_expired(self, entry_dir: str) -> None:
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        with self._lock:
+            self._counters['expired'] += 1
+
+    def get(self, key: str) -> Optional[StoredComic]:
+        stored = self._load(key)
+        with self._lock:
+            self._counters['hits' if stored is not None else 'misses'] += 1
+        return stored
+
+    def _load(self, key: str) -> Optional[StoredComic]:
+        try:
+            with open(self._manifest_path(key), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            entry_dir = os.path.join(self.directory, key)
+            if self._expired(manifest):
+                self._remove_expired(entry_dir)
+                return None
+            pages = [os.path.join(entry_dir, name) for name in manifest['pages']]
+            if not all(os.path.isfile(p) for p in pages):
+                raise FileNotFoundError(entry_dir)
+            os.utime(entry_dir)
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+        file_ids = manifest.get('file_ids') or [None] * len(pages)
+        return StoredComic(key, pages, file_ids)
+
+    def put(self, key: str, page_paths: list[str]) -> StoredComic:
+        """Копирует страницы в хранилище и возвращает запись с путями внутри него."""
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        try:
+            names = []
+            for i, path in enumerate(page_paths, start=1):
+                name = f"p{i}{os.path.splitext(path)[1]}"
+                shutil.copyfile(path, os.path.join(tmp_dir, name))
+                names.append(name)
+            with open(os.path.join(tmp_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+                json.dump({'pages': names, 'file_ids': [None] * len(names), 'created': time.time()}, f)
+            entry_dir = os.path.join(self.directory, key)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # запись уже создал параллельный процесс — оставляем его версию
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        with self._lock:
+            self._counters['writes'] += 1
+        self._evict()
+        stored = self._load(key)
+        return stored if stored is not None else StoredComic(key, list(page_paths), [None] * len(page_paths))
+
+    def set_file_ids(self, key: str, file_ids: list[Optional[str]]) -> None:
+        """Запоминает file_id отправленных страниц, чтобы в следующий раз не загружать файлы заново."""
+        manifest_path = self._manifest_path(key)
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            manifest['file_ids'] = file_ids
+            fd, tmp_path = tempfile.mkstemp(prefix='.', dir=os.path.dirname(manifest_path))
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, manifest_path)
+        except (OSError, ValueError) as e:
+            print(f"[results] Не удалось сохранить file_id для {key}: {e}")
+
+    def _evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if self.ttl and self._entry_expired(path):
+                self._remove_expired(path)
+                continue
+            entries.append((mtime, path))
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for _mtime, path in entries[:len(entries) - self.max_entries]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+
+class SingleFlight:
+    """
+    Дедупликация одновременных вычислений по ключу: пока задача для ключа выполняется,
+    остальные вызовы с тем же ключом ждут её результата вместо повторного запуска.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: dict[str, Future] = {}
+
+    def do(self, key: str, fn: Callable, on_wait: Optional[Callable[[], None]] = None):
+        """
+        Выполняет fn() для ключа ровно один раз среди одновременных вызовов.
+
+        on_wait вызывается, если результат уже считается в другом потоке и мы будем его ждать.
+        Исключение лидера пробрасывается всем ожидающим.
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+        if not leader:
+            if on_wait is not None:
+                on_wait()
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+
+def get_result_store() -> Optional[ResultStore]:
+    """Ленивая инициализация общего хранилища результатов (None, если оно выключено)."""
+    global _store
+    if STORE_ENABLED and _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ResultStore(STORE_DIR, max_entries=STORE_MAX_ENTRIES, ttl=STORE_TTL)
+    return _store
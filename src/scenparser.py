@@ -1,49 +1,354 @@
 import re
-from typing import Dict
+from difflib import get_close_matches
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
 
 def parse_scenario(text: str) -> Dict:
-    result = {
-        'charLdesc': [],
-        'charRdesc': [], 
-        'scenes': [],
-        'charLaction': [],
-        'charRaction': []
-    }
-    
-    patterns = {
-        'charL_desc': r'\[charLdescStart\](.*?)\[charLdescEnd\]',
-        'charR_desc': r'\[charRdescStart\](.*?)\[charRdescEnd\]',
-        'scene': r'\[scene\](.*?)\[endscene\]',
-        'charL_dialogue': r'\[charL\](.*?)\[charLend\]',
-        'charR_dialogue': r'\[charR\](.*?)\[charRend\]',
-    }
-    
-    char_l_desc = re.search(patterns['charL_desc'], text, re.DOTALL)
-    if char_l_desc:
-        content = char_l_desc.group(1).strip()
-        result['charLdesc'].append(content if content else None)
-    
-    char_r_desc = re.search(patterns['charR_desc'], text, re.DOTALL)
-    if char_r_desc:
-        content = char_r_desc.group(1).strip()
-        result['charRdesc'].append(content if content else None)
-    
-    scenes = re.findall(patterns['scene'], text, re.DOTALL)
-    result['scenes'] = [scene.strip() if scene.strip() else None for scene in scenes]
-    
-    charL_dialogues = re.findall(patterns['charL_dialogue'], text, re.DOTALL)
-    result['charLaction'] = [
-        dialogue.strip() if dialogue.strip() and dialogue.strip() != '[placeholder]' else None 
-        for dialogue in charL_dialogues
-    ]
-    
-    charR_dialogues = re.findall(patterns['charR_dialogue'], text, re.DOTALL)
-    result['charRaction'] = [
-        dialogue.strip() if dialogue.strip() and dialogue.strip() != '[placeholder]' else None 
-        for dialogue in charR_dialogues
-    ]
-    
-    return result
-
-    
+    """
+    Разбирает сценарий целиком и возвращает словарь (charLdesc, charRdesc, scenes, charLaction, charRaction).
+
+    Реплики привязываются к своей сцене, поэтому пропущенный блок не сдвигает
+    реплики остальных сцен; типичные дефекты разметки чинятся на месте (см. ScenarioStreamParser).
+    """
+    parser = ScenarioStreamParser()
+    parser.feed(text)
+    parser.finish()
+    return parser.result()
+
+
+_MARKDOWN_RE = re.compile(r'\*\*|__|`+|^\s*#+\s*|^\s*[-*]\s+', re.MULTILINE)
+
+
+def _strip_markdown(text: str) -> str:
+    return _MARKDOWN_RE.sub('', text).strip()
+
+
+def _clean_dialogue(dialogue: str) -> Optional[str]:
+    dialogue = _strip_markdown(dialogue.replace('[placeholder]', ''))
+    # «placeholder» без скобок тоже означает, что персонаж молчит
+    return dialogue if dialogue and dialogue.lower() != 'placeholder' else None
+
+
+@dataclass(slots=True)
+class Scene:
+    """Одна сцена сценария: описание и реплики левого/правого персонажа (None — молчит)."""
+    index: int
+    description: Optional[str]
+    charLaction: Optional[str] = None
+    charRaction: Optional[str] = None
+
+
+@dataclass(slots=True)
+class ScenarioIssue:
+    """
+    Структурная ошибка разметки сценария.
+
+    repaired=True — исправлена локально (результат уже учитывает исправление);
+    False — локально не исправить, нужен дозапрос к LLM (см. repair_with_llm).
+    """
+    kind: str
+    message: str
+    line: int
+    scene: Optional[int] = None
+    repaired: bool = True
+
+
+# Каноническое имя тега (в нижнем регистре, без пробелов и «_») -> (open|close|placeholder, поле)
+_TAGS = {
+    'scene': ('open', 'scene'),
+    'endscene': ('close', 'scene'),
+    '/scene': ('close', 'scene'),
+    'charl': ('open', 'charL'),
+    'charlend': ('close', 'charL'),
+    'endcharl': ('close', 'charL'),
+    '/charl': ('close', 'charL'),
+    'charr': ('open', 'charR'),
+    'charrend': ('close', 'charR'),
+    'endcharr': ('close', 'charR'),
+    '/charr': ('close', 'charR'),
+    'charldescstart': ('open', 'charLdesc'),
+    'charldesc': ('open', 'charLdesc'),
+    'charldescend': ('close', 'charLdesc'),
+    '/charldesc': ('close', 'charLdesc'),
+    'charrdescstart': ('open', 'charRdesc'),
+    'charrdesc': ('open', 'charRdesc'),
+    'charrdescend': ('close', 'charRdesc'),
+    '/charrdesc': ('close', 'charRdesc'),
+    'placeholder': ('placeholder', None),
+}
+_TAG_RE = re.compile(r'\[\s*(/?\s*[A-Za-z][A-Za-z_ ]{2,24}?)\s*\]')
+# Незакрытая «[» в конце куска может оказаться началом тега — такой хвост ждёт следующего куска
+_PARTIAL_TAG_RE = re.compile(r'\[[^\[\]\n]{0,28}$')
+
+
+def tokenize(text: str, start: int = 0, end: Optional[int] = None) -> Iterator[Tuple[str, Optional[str], int, int, bool]]:
+    """
+    Один проход по тексту: (вид, поле, начало, конец, точное ли совпадение) для каждого тега.
+
+    Вид — open / close / placeholder; регистр, пробелы и «_» внутри скобок не важны
+    ([Scene], [end scene], [/charL] тоже распознаются), опечатки вроде [charLdecEnd]
+    узнаются по близости к известному тегу (точное=False). Прочие [..] считаются текстом.
+    """
+    for m in _TAG_RE.finditer(text, start, len(text) if end is None else end):
+        name = re.sub(r'[\s_]', '', m.group(1)).lower()
+        exact = name in _TAGS
+        if not exact:
+            close = get_close_matches(name, _TAGS, n=1, cutoff=0.85)
+            if not close:
+                continue
+            name = close[0]
+        kind, field_name = _TAGS[name]
+        yield kind, field_name, m.start(), m.end(), exact
+
+
+class ScenarioStreamParser:
+    """
+    Однопроходный парсер сценария на токенизаторе, в том числе для потокового ответа LLM.
+
+    feed() принимает очередной кусок текста и возвращает сцены, которые стали
+    полными: закрылись оба блока реплик ([charL] и [charR], в любом порядке) либо
+    началась следующая [scene]. finish()
+    дочитывает хвост в конце потока. Реплики всегда относятся к текущей сцене.
+
+    Локально чинятся: незакрытые блоки (закрываются перед следующим тегом или в конце текста),
+    закрывающий тег без открывающего (содержимым считается текст после предыдущего тега),
+    лишняя markdown-разметка, отсутствующие блоки реплик (= [placeholder]),
+    повторные блоки в одной сцене (берётся первый). Всё это и то, что локально
+    не починить (нет описаний персонажей, пустое описание сцены), попадает в issues.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.charLdesc: Optional[str] = None
+        self.charRdesc: Optional[str] = None
+        self.scenes: List[Scene] = []
+        self.issues: List[ScenarioIssue] = []
+        # до какого места текст уже разобран
+        self._pos = 0
+        # открытый блок: (поле, начало содержимого, строка открывающего тега)
+        self._open: Optional[Tuple[str, int, int]] = None
+        # конец последнего тега: отсюда начинается содержимое блока без открывающего тега
+        self._last_tag_end = 0
+        self._current: Optional[Scene] = None
+        self._current_fields: set = set()
+
+    # -- учёт ошибок -------------------------------------------------------
+
+    def _line(self, pos: int) -> int:
+        return self.text.count('\n', 0, pos) + 1
+
+    def _issue(self, kind: str, message: str, pos: int, repaired: bool = True) -> None:
+        scene = self._current.index if self._current is not None else None
+        self.issues.append(ScenarioIssue(kind, message, self._line(pos), scene, repaired))
+
+    # -- сборка сцен -------------------------------------------------------
+
+    def _complete_scene(self, ready: List[Scene], pos: int) -> None:
+        scene = self._current
+        if scene is None:
+            return
+        for name in ('charL', 'charR'):
+            if name not in self._current_fields:
+                self._issue('missing_block', f"В сцене {scene.index + 1} нет блока [{name}] — персонаж молчит", pos)
+        if scene.description is None:
+            self._issue('empty_scene', f"У сцены {scene.index + 1} пустое описание", pos, repaired=False)
+        self.scenes.append(scene)
+        ready.append(scene)
+        self._current = None
+        self._current_fields = set()
+
+    def _store(self, name: str, content: str, pos: int, ready: List[Scene]) -> None:
+        if name in ('charLdesc', 'charRdesc'):
+            if getattr(self, name) is not None:
+                self._issue('duplicate_block', f"Повторное описание [{name}] проигнорировано", pos)
+                return
+            setattr(self, name, _strip_markdown(content) or None)
+            return
+
+        if name == 'scene':
+            self._complete_scene(ready, pos)
+            self._current = Scene(len(self.scenes), _strip_markdown(content) or None)
+            self._current_fields = {'scene'}
+            return
+
+        # реплика
+        if self._current is None:
+            self._issue('orphan_dialogue', f"Блок [{name}] вне сцены проигнорирован", pos)
+            return
+        if name in self._current_fields:
+            self._issue('duplicate_block', f"Повторный блок [{name}] в сцене {self._current.index + 1} проигнорирован", pos)
+            return
+        self._current_fields.add(name)
+        setattr(self._current, name + 'action', _clean_dialogue(content))
+        if {'charL', 'charR'} <= self._current_fields:
+            # обе реплики на месте — сцена полная, её можно рендерить, не дожидаясь следующей [scene]
+            self._complete_scene(ready, pos)
+
+    def _close_open(self, at: int, ready: List[Scene], reason: str) -> None:
+        name, content_start, _line = self._open
+        self._open = None
+        self._issue('unclosed_tag', f"Блок [{name}] не закрыт — закрыт {reason}", at)
+        self._store(name, self.text[content_start:at], at, ready)
+
+    def _process(self, end: int, ready: List[Scene]) -> None:
+        text = self.text
+        for kind, name, start, stop, exact in tokenize(text, self._pos, end):
+            if not exact:
+                self._issue('typo_tag', f"Тег {text[start:stop]} распознан как тег блока [{name}]", start)
+            if kind == 'placeholder':
+                # [placeholder] вне блока реплики — пропущен открывающий тег, читаем как молчание
+                if self._open is None and self._current is not None:
+                    self._last_tag_end = start
+                continue
+            if kind == 'open':
+                if self._open is not None:
+                    self._close_open(start, ready, f"перед [{name}]")
+                if name == 'scene':
+                    # началась следующая сцена — предыдущая готова, даже если в ней не было [charR]
+                    self._complete_scene(ready, start)
+                self._open = (name, stop, self._line(start))
+            else:
+                if self._open is not None and self._open[0] == name:
+                    self._store(name, text[self._open[1]:start], start, ready)
+                    self._open = None
+                elif self._open is not None:
+                    # закрывающий тег другого блока: закрываем открытый и чиним пропущенное открытие
+                    self._close_open(start, ready, f"перед [{name}] без пары")
+                    self._issue('missing_open', f"Закрывающий тег блока [{name}] без открывающего пропущен", start)
+                elif text[self._last_tag_end:start].strip():
+                    self._issue('missing_open', f"Нет открывающего тега для блока [{name}] — добавлен", start)
+                    self._store(name, text[self._last_tag_end:start], start, ready)
+                else:
+                    self._issue('stray_close', f"Лишний закрывающий тег блока [{name}] пропущен", start)
+            self._last_tag_end = stop
+        self._pos = end
+
+    # -- публичный интерфейс -----------------------------------------------
+
+    def feed(self, chunk: str) -> List[Scene]:
+        self.text += chunk
+        end = len(self.text)
+        partial = _PARTIAL_TAG_RE.search(self.text, self._pos)
+        if partial:
+            end = partial.start()
+        ready: List[Scene] = []
+        self._process(end, ready)
+        return ready
+
+    def finish(self) -> List[Scene]:
+        ready: List[Scene] = []
+        self._process(len(self.text), ready)
+        if self._open is not None:
+            self._close_open(len(self.text), ready, "в конце текста")
+        self._complete_scene(ready, len(self.text))
+        for name in ('charLdesc', 'charRdesc'):
+            if getattr(self, name) is None:
+                self._issue('missing_description', f"Нет описания персонажа [{name}]", len(self.text), repaired=False)
+        if not self.scenes:
+            self._issue('no_scenes', "В сценарии нет ни одной сцены", len(self.text), repaired=False)
+        return ready
+
+    @property
+    def unrepaired(self) -> List[ScenarioIssue]:
+        """Ошибки, которые не удалось исправить локально."""
+        return [issue for issue in self.issues if not issue.repaired]
+
+    def result(self) -> Dict:
+        """Разобранный сценарий в формате parse_scenario."""
+        return {
+            'charLdesc': [self.charLdesc] if self.charLdesc is not None else [],
+            'charRdesc': [self.charRdesc] if self.charRdesc is not None else [],
+            'scenes': [scene.description for scene in self.scenes],
+            'charLaction': [scene.charLaction for scene in self.scenes],
+            'charRaction': [scene.charRaction for scene in self.scenes],
+        }
+
+
+_REASK_DESCRIPTION = (
+    """Ниже фрагмент сценария комикса. В нём не хватает описания {who} персонажа.
+                Напиши только его внешность на английском (кратко, как промпт для генеративной модели),
+                строго между тегами {open_tag} и {close_tag}, без пояснений.
+                Фрагмент сценария:
+                {context}
+            """
+)
+
+_REASK_SCENE = (
+    """Ниже фрагмент сценария комикса. У сцены номер {number} пустое описание.
+                Напиши только описание этой сцены на английском (кратко: ракурс, обстановка, действия персонажей,
+                один слева, другой справа, без надписей и без реплик), строго между тегами [scene] и [endscene].
+                Фрагмент сценария:
+                {context}
+            """
+)
+
+# Сколько первых сцен показываем модели, когда просим описать персонажа
+_REASK_DESCRIPTION_SCENES = 2
+
+
+def _repair_context(parser: ScenarioStreamParser, scenes: List[Scene]) -> str:
+    """Описания персонажей и сцены scenes (описание и реплики) — контекст дозапроса вместо всего сценария."""
+    lines = []
+    if parser.charLdesc:
+        lines.append(f"Левый персонаж: {parser.charLdesc}")
+    if parser.charRdesc:
+        lines.append(f"Правый персонаж: {parser.charRdesc}")
+    for scene in scenes:
+        lines.append(f"Сцена {scene.index + 1}: {scene.description or '(описания нет)'}")
+        if scene.charLaction:
+            lines.append(f"Реплика левого персонажа: {scene.charLaction}")
+        if scene.charRaction:
+            lines.append(f"Реплика правого персонажа: {scene.charRaction}")
+    return "\n".join(lines)
+
+
+def _extract_block(answer: str, name: str) -> Optional[str]:
+    parser = ScenarioStreamParser()
+    parser.feed(answer)
+    parser.finish()
+    if name == 'scene':
+        return parser.scenes[0].description if parser.scenes else None
+    return getattr(parser, name)
+
+
+def repair_with_llm(parser: ScenarioStreamParser, ask: Callable[[str], str]) -> List[ScenarioIssue]:
+    """
+    Точечный дозапрос к LLM только того, что нельзя исправить локально: описаний
+    персонажей и пустых описаний сцен. Сценарий целиком не перегенерируется и
+    целиком не отправляется: в промпт идут описания персонажей и сама сцена с соседними.
+
+    ask(prompt) -> ответ модели. Исправленные ошибки помечаются repaired=True;
+    возвращаются оставшиеся неисправленными (например, сценарий без сцен).
+    """
+    for issue in parser.unrepaired:
+        answer_name = None
+        if issue.kind == 'missing_description':
+            answer_name = 'charLdesc' if 'charLdesc' in issue.message else 'charRdesc'
+            who = 'левого' if answer_name == 'charLdesc' else 'правого'
+            prompt = _REASK_DESCRIPTION.format(
+                who=who,
+                open_tag=f"[{answer_name}Start]",
+                close_tag=f"[{answer_name}End]",
+                context=_repair_context(parser, parser.scenes[:_REASK_DESCRIPTION_SCENES]),
+            )
+        elif issue.kind == 'empty_scene' and issue.scene is not None:
+            answer_name = 'scene'
+            neighbours = parser.scenes[max(0, issue.scene - 1):issue.scene + 2]
+            prompt = _REASK_SCENE.format(number=issue.scene + 1, context=_repair_context(parser, neighbours))
+        else:
+            continue
+
+        try:
+            value = _extract_block(ask(prompt), answer_name)
+        except Exception as e:
+            print(f"[scenario] Дозапрос не удался ({issue.message}): {e}")
+            continue
+        if not value:
+            continue
+        if answer_name == 'scene':
+            parser.scenes[issue.scene].description = value
+        else:
+            setattr(parser, answer_name, value)
+        issue.repaired = True
+    return parser.unrepaired
@@ -1,13 +1,18 @@
 import os
+import hashlib
 import tempfile
 import traceback
 import io
+import threading
 
 import telebot
+from telebot import types
 from dotenv import load_dotenv, find_dotenv
-from PIL import Image
 
-from .pipeline import generate_comic_from_pdf
+from .pipeline import iter_comic_from_pdf, ScenarioReady, PanelRendered, ComicReady, PIPELINE_VERSION
+from .resultstore import ResultStore, SingleFlight, StoredComic, get_result_store
+from .yolo_detect import warmup_model, get_model_stats
+from .jobqueue import JobQueue, QueueFull, UserLimitExceeded
 try:
     from openai import AuthenticationError, RateLimitError, NotFoundError
 except Exception:
@@ -30,78 +35,194 @@ def get_bot() -> telebot.TeleBot:
 
 bot = get_bot()
 
+TELEGRAM_MAX_SIDE = 2048
+TELEGRAM_JPEG_QUALITY = 85
+# Длинные комиксы отправляются страницами 2x2: меньше пиковая память и Telegram не ужимает огромный холст
+TELEGRAM_PANELS_PER_PAGE = int(os.getenv("COMIX_PANELS_PER_PAGE", "4"))
 
-def _prepare_image_for_telegram(png_path: str) -> str:
-    """Конвертирует PNG в более лёгкий JPEG (и даунскейлит, если очень большое изображение).
-    Возвращает путь к временному JPEG-файлу. При ошибке возвращает исходный путь."""
+# Конвейер выполняется не в обработчике сообщений, а пулом воркеров: один длинный комикс не блокирует остальных
+jobs = JobQueue(
+    workers=int(os.getenv("COMIX_BOT_WORKERS", "2")),
+    max_queue=int(os.getenv("COMIX_BOT_QUEUE_SIZE", "20")),
+    per_user_limit=int(os.getenv("COMIX_BOT_PER_USER", "1")),
+)
+
+# Одновременные загрузки одного и того же PDF ждут общий прогон конвейера
+inflight = SingleFlight()
+
+
+def _send_progress(message, text: str) -> None:
+    """Промежуточное сообщение о ходе генерации; его ошибка не должна ронять задачу."""
     try:
-        with Image.open(png_path) as im:
-            im = im.convert('RGB')
-            max_side = 2048
-            w, h = im.size
-            if max(w, h) > max_side:
-                scale = max_side / float(max(w, h))
-                im = im.resize((int(w*scale), int(h*scale)), Image.LANCZOS)
-
-            fd, tmp_jpg = tempfile.mkstemp(suffix='.jpg')
-            os.close(fd)
-            im.save(tmp_jpg, format='JPEG', quality=85, optimize=True)
-            return tmp_jpg
+        bot.send_message(message.chat.id, text)
     except Exception:
-        pass
-    return png_path
+        traceback.print_exc()
+
+
+def _send_panel_preview(message, image_bytes: bytes, caption: str) -> None:
+    """Отправляет превью готовой сцены (без пузырьков); ошибки отправки только логируются."""
+    try:
+        bot.send_photo(message.chat.id, io.BytesIO(image_bytes), caption=caption)
+    except Exception:
+        traceback.print_exc()
+
+
+def _send_with_retries(send, attempts: int = 3):
+    """Отправляем результат с увеличенным таймаутом и ретраями; возвращает то, что вернул send()."""
+    last_err = None
+    for _ in range(attempts):
+        try:
+            return send()
+        except Exception as e:
+            last_err = e
+    raise last_err
+
+
+def _sent_file_id(sent):
+    document = getattr(sent, 'document', None)
+    return document.file_id if document else None
+
+
+def _send_single_page(message, path: str, file_id=None):
+    """Отправляет страницу документом; если file_id уже известен, Telegram не загружает файл заново."""
+    if file_id:
+        sent = bot.send_document(message.chat.id, file_id, timeout=300)
+    else:
+        with open(path, 'rb') as f:
+            sent = bot.send_document(
+                message.chat.id,
+                f,
+                visible_file_name=os.path.basename(path),
+                timeout=300,
+            )
+    return [_sent_file_id(sent)]
+
+
+def _send_page_group(message, paths: list, file_ids=None):
+    file_ids = file_ids or [None] * len(paths)
+    files = [None if fid else open(path, 'rb') for path, fid in zip(paths, file_ids)]
+    try:
+        media = [types.InputMediaDocument(fid or f) for f, fid in zip(files, file_ids)]
+        sent = bot.send_media_group(message.chat.id, media, timeout=300)
+    finally:
+        for f in files:
+            if f is not None:
+                f.close()
+    return [_sent_file_id(m) for m in sent]
+
+
+def _album_bounds(count: int, limit: int = 10) -> list:
+    """Делит count > 1 страниц на альбомы почти равного размера (не больше limit, не меньше 2)."""
+    albums = -(-count // limit)
+    bounds, start = [], 0
+    for n in range(albums):
+        end = start + count // albums + (1 if n < count % albums else 0)
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def _deliver_pages(message, pages: list, file_ids: list) -> list:
+    """Одна страница — документом, несколько — альбомами (до 10 файлов в альбоме). Возвращает file_id страниц."""
+    if len(pages) == 1:
+        return _send_with_retries(lambda: _send_single_page(message, pages[0], file_ids[0]))
+    sent_ids = []
+    # Альбом из одного файла Telegram отклоняет, поэтому страницы делим поровну, а не по 10 с хвостом
+    for start, end in _album_bounds(len(pages)):
+        group = pages[start:end]
+        ids = file_ids[start:end]
+        sent_ids.extend(_send_with_retries(lambda group=group, ids=ids: _send_page_group(message, group, ids)))
+    return sent_ids
+
+
+def _send_comic(message, comic: StoredComic) -> None:
+    """Отправляет готовый комикс и запоминает file_id страниц в хранилище для повторных отправок."""
+    file_ids = list(comic.file_ids) if len(comic.file_ids) == len(comic.pages) else [None] * len(comic.pages)
+    try:
+        sent_ids = _deliver_pages(message, comic.pages, file_ids)
+    except Exception:
+        if not any(file_ids):
+            raise
+        # file_id мог стать недействительным (например, сменился токен бота) — загружаем файлы заново
+        traceback.print_exc()
+        sent_ids = _deliver_pages(message, comic.pages, [None] * len(comic.pages))
+
+    store = get_result_store()
+    if store is not None and any(sent_ids) and sent_ids != comic.file_ids:
+        store.set_file_ids(comic.key, sent_ids)
 
 
 @bot.message_handler(commands=['start', 'help'])
 def send_welcome(message):
     bot.reply_to(
         message,
-        "Приветствую Вас! Отправьте PDF-файл с документом. Я верну сгенерированный комикс в PNG."
+        "Приветствую Вас! Отправьте PDF-файл с документом. Я верну сгенерированный комикс в JPEG."
     )
 
 
 @bot.message_handler(content_types=['document'])
 def handle_document(message):
+    doc = message.document
+    if not (doc.file_name or '').lower().endswith('.pdf'):
+        bot.reply_to(message, "Пожалуйста, отправьте файл в формате PDF.")
+        return
+
+    try:
+        ahead = jobs.submit(message.from_user.id, _process_document, message)
+    except UserLimitExceeded:
+        bot.reply_to(message, "Ваш предыдущий документ ещё обрабатывается. Дождитесь комикса и отправьте следующий.")
+        return
+    except QueueFull:
+        bot.reply_to(message, "Сейчас слишком много запросов, очередь заполнена. Попробуйте, пожалуйста, через несколько минут.")
+        return
+
+    if ahead:
+        bot.reply_to(message, f"Документ получен и поставлен в очередь. Перед Вами документов: {ahead}. Начну, как только подойдёт очередь.")
+
+
+def _process_document(message):
     try:
         doc = message.document
-        if not doc.file_name.lower().endswith('.pdf'):
-            bot.reply_to(message, "Пожалуйста, отправьте файл в формате PDF.")
-            return
 
         # Скачиваем PDF во временный файл
         file_info = bot.get_file(doc.file_id)
         downloaded = bot.download_file(file_info.file_path)
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_pdf:
-            tmp_pdf.write(downloaded)
-            tmp_pdf_path = tmp_pdf.name
-
-        bot.reply_to(message, "Документ получен. Начинаю генерацию комикса, это может занять несколько минут, наберитесь терпения, пожалуйста...")
-
-        # Генерация комикса
-        output_path = generate_comic_from_pdf(tmp_pdf_path)
-
-        # Подготовим файл к отправке (сжатие/даунскейл)
-        send_path = _prepare_image_for_telegram(output_path)
+        # Один и тот же PDF (по содержимому, а не по имени) с теми же настройками вывода — один и тот же комикс
+        key = ResultStore.key(
+            hashlib.sha256(downloaded).hexdigest(),
+            PIPELINE_VERSION,
+            format='JPEG',
+            quality=TELEGRAM_JPEG_QUALITY,
+            max_side=TELEGRAM_MAX_SIDE,
+            panels_per_page=TELEGRAM_PANELS_PER_PAGE,
+        )
+        store = get_result_store()
+        stored = store.get(key) if store is not None else None
+        if stored is not None:
+            bot.reply_to(message, "Этот документ у нас уже был — отправляю готовый комикс.")
+            _send_comic(message, stored)
+            return
 
-        # Отправляем результат с увеличенным таймаутом и ретраями
-        attempts = 3
-        last_err = None
-        for _ in range(attempts):
+        def generate() -> StoredComic:
+            # PDF пишет на диск только тот, кто генерирует; дождавшиеся чужого результата копию не создают
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_pdf:
+                tmp_pdf.write(downloaded)
+                tmp_pdf_path = tmp_pdf.name
             try:
-                with open(send_path, 'rb') as f:
-                    bot.send_document(
-                        message.chat.id,
-                        f,
-                        visible_file_name=os.path.basename(send_path),
-                        timeout=300,
-                    )
-                last_err = None
-                break
-            except Exception as e:
-                last_err = e
-        if last_err:
-            raise last_err
+                return _generate_comic(message, tmp_pdf_path, key)
+            finally:
+                os.unlink(tmp_pdf_path)
+
+        comic = inflight.do(
+            key,
+            generate,
+            on_wait=lambda: bot.reply_to(
+                message,
+                "Такой же документ уже обрабатывается — пришлю комикс, как только он будет готов."
+            ),
+        )
+        _send_comic(message, comic)
 
     except Exception as e:
         # Логи для разработчика
@@ -136,6 +257,53 @@ def handle_document(message):
         )
 
 
+def _generate_comic(message, tmp_pdf_path: str, key: str) -> StoredComic:
+    """Прогон конвейера для документа; результат сохраняется в хранилище (если оно включено)."""
+    bot.reply_to(message, "Документ получен. Начинаю генерацию комикса, это может занять несколько минут, наберитесь терпения, пожалуйста...")
+
+    # Генерация комикса: по ходу работы показываем пользователю готовые сцены
+    pages = []
+    degraded = False
+    scene_count = 0
+    # Итог сразу пишется в JPEG нужного для Telegram размера — без промежуточного PNG и перекодирования
+    events = iter_comic_from_pdf(
+        tmp_pdf_path,
+        output_format='JPEG',
+        quality=TELEGRAM_JPEG_QUALITY,
+        max_side=TELEGRAM_MAX_SIDE,
+        panels_per_page=TELEGRAM_PANELS_PER_PAGE,
+    )
+    for event in events:
+        if isinstance(event, ScenarioReady):
+            scene_count = event.scene_count
+            _send_progress(message, f"Сценарий готов: {scene_count} сцен. Рисую картинки...")
+        elif isinstance(event, PanelRendered):
+            _send_panel_preview(message, event.image, f"Сцена {event.index + 1} из {scene_count}")
+        elif isinstance(event, ComicReady):
+            pages = event.pages
+            degraded = event.degraded
+
+    store = get_result_store()
+    # С заглушками вместо сцен комикс не сохраняем: следующая попытка может нарисовать его целиком
+    if store is not None and not degraded:
+        try:
+            return store.put(key, pages)
+        except OSError:
+            # Не удалось сохранить — не беда, отправим из временных файлов
+            traceback.print_exc()
+    return StoredComic(key, pages, [None] * len(pages))
+
+
+def _warmup_detector():
+    try:
+        warmup_model()
+        print(f"[bot] Детектор лиц прогрет: {get_model_stats()}")
+    except Exception:
+        traceback.print_exc()
+
+
 if __name__ == '__main__':
+    # Грузим веса YOLO в фоне, чтобы первый документ не ждал загрузки модели
+    threading.Thread(target=_warmup_detector, name='yolo-warmup', daemon=True).start()
     print("Telegram bot is running. Press Ctrl+C to stop.")
     bot.infinity_polling(skip_pending=True)
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+from PIL import Image, ImageDraw, ImageFont
+
+DEFAULT_FONT = "arial.ttf"
+LINE_SPACING = 4
+
+# Общий холст только для измерений: textbbox ничего на нём не рисует
+_MEASURE_DRAW = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+
+
+@lru_cache(maxsize=64)
+def load_font(font_path: Optional[str], size: int):
+    """Загруженные шрифты кэшируются по (путь, размер): truetype читает файл с диска при каждом вызове."""
+    try:
+        return ImageFont.truetype(font_path or DEFAULT_FONT, size)
+    except Exception:
+        try:
+            return ImageFont.load_default(size)
+        except TypeError:
+            # Pillow < 10.1: встроенный шрифт без размера
+            return ImageFont.load_default()
+
+
+@lru_cache(maxsize=16384)
+def word_width(font_path: Optional[str], size: int, word: str) -> float:
+    return load_font(font_path, size).getlength(word)
+
+
+@lru_cache(maxsize=256)
+def line_height(font_path: Optional[str], size: int) -> int:
+    bbox = load_font(font_path, size).getbbox("Ay")
+    return bbox[3] - bbox[1]
+
+
+@lru_cache(maxsize=4096)
+def measure_block(font_path: Optional[str], size: int, wrapped_text: str) -> tuple[int, int]:
+    """Точный размер многострочного блока (как его нарисует multiline_text)."""
+    bbox = _MEASURE_DRAW.multiline_textbbox(
+        (0, 0), wrapped_text, font=load_font(font_path, size), spacing=LINE_SPACING
+    )
+    return bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+
+@dataclass
+class TextLayout:
+    """Результат раскладки реплики: шрифт, текст с переносами и размер блока в пикселях."""
+    font: object
+    font_size: int
+    wrapped_text: str
+    width: int
+    height: int
+
+
+class TextLayoutEngine:
+    """
+    Подбирает для реплики наибольший размер шрифта, при котором текст, перенесённый
+    по реальной ширине слов, помещается в max_width x max_height.
+
+    Размер ищется бинарным поиском; ширины слов и высоты строк мемоизированы,
+    поэтому повторные раскладки (те же реплики, тот же шрифт) почти бесплатны.
+    """
+
+    def __init__(self, font_path: Optional[str] = None, min_font_size: int = 6, max_font_size: int = 40):
+        self.font_path = font_path
+        self.min_font_size = min_font_size
+        self.max_font_size = max(max_font_size, min_font_size)
+
+    def wrap(self, text: str, size: int, max_width: int) -> tuple[list[str], float]:
+        """Жадный перенос по измеренной ширине слов; возвращает строки и ширину самой длинной."""
+        space = word_width(self.font_path, size, " ")
+        lines: list[str] = []
+        current: list[str] = []
+        current_width = 0.0
+        widest = 0.0
+        for word in text.split():
+            w = word_width(self.font_path, size, word)
+            candidate = current_width + (space if current else 0) + w
+            if current and candidate > max_width:
+                lines.append(" ".join(current))
+                widest = max(widest, current_width)
+                current, current_width = [word], w
+            else:
+                current.append(word)
+                current_width = candidate
+        if current:
+            lines.append(" ".join(current))
+            widest = max(widest, current_width)
+        return lines, widest
+
+    def _fits(self, text: str, size: int, max_width: int, max_height: int) -> bool:
+        lines, widest = self.wrap(text, size, max_width)
+        height = len(lines) * line_height(self.font_path, size) + (len(lines) - 1) * LINE_SPACING
+        return widest <= max_width and height <= max_height
+
+    def fit(self, text: str, max_width: int, max_height: Optional[int] = None) -> TextLayout:
+        if max_height is None:
+            max_height = max_width // 2
+        lo, hi = self.min_font_size, self.max_font_size
+        best = self.min_font_size
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            if self._fits(text, mid, max_width, max_height):
+                best = mid
+                lo = mid + 1
+            else:
+                hi = mid - 1
+
+        lines, _widest = self.wrap(text, best, max_width)
+        wrapped_text = "\n".join(lines)
+        width, height = measure_block(self.font_path, best, wrapped_text)
+        return TextLayout(load_font(self.font_path, best), best, wrapped_text, width, height)
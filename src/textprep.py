@@ -0,0 +1,143 @@
+from __future__ import annotations
+import math
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional
+
+# Грубая оценка для смеси русского и английского текста (токенайзер модели нам недоступен)
+CHARS_PER_TOKEN = 3.0
+DEFAULT_TOKEN_BUDGET = int(os.getenv("COMIX_TOKEN_BUDGET", "30000"))
+
+# Колонтитулы ищем только среди нескольких первых/последних строк страницы
+_EDGE_LINES = 3
+
+_WS_RE = re.compile(r"[ \t\u00a0\u200b]+")
+_HYPHEN_RE = re.compile(r"(\w)[-\u00ad]\n\s*([a-zа-яё])")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+_PAGE_NUMBER_RE = re.compile(r"^(стр\.?|страница|page)?\s*\d+(\s*(из|of|/)\s*\d+)?$", re.IGNORECASE)
+
+
+@dataclass
+class PrepReport:
+    """Что сделала нормализация с документом."""
+    chars_before: int = 0
+    chars_after: int = 0
+    tokens_before: int = 0
+    tokens_after: int = 0
+    header_footer_lines_removed: int = 0
+    duplicate_paragraphs_removed: int = 0
+    hyphenations_joined: int = 0
+    truncated: bool = False
+
+    @property
+    def removed_fraction(self) -> float:
+        return 1 - self.chars_after / self.chars_before if self.chars_before else 0.0
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _line_signature(line: str) -> str:
+    # Номера страниц в колонтитулах меняются, поэтому цифры не учитываем
+    return re.sub(r"\d+", "#", _WS_RE.sub(" ", line).strip().lower())
+
+
+def _strip_headers_footers(pages: list[str], report: PrepReport) -> list[str]:
+    split_pages = [page.splitlines() for page in pages]
+    if len(split_pages) >= 2:
+        edge_counts = Counter()
+        for lines in split_pages:
+            edges = lines[:_EDGE_LINES] + lines[-_EDGE_LINES:]
+            edge_counts.update({_line_signature(line) for line in edges if line.strip()})
+        threshold = max(2, math.ceil(len(split_pages) / 2))
+        repeated = {sig for sig, n in edge_counts.items() if n >= threshold}
+    else:
+        repeated = set()
+
+    cleaned = []
+    for lines in split_pages:
+        kept = []
+        for pos, line in enumerate(lines):
+            on_edge = pos < _EDGE_LINES or pos >= len(lines) - _EDGE_LINES
+            stripped = line.strip()
+            if on_edge and stripped and (_line_signature(line) in repeated or _PAGE_NUMBER_RE.match(stripped)):
+                report.header_footer_lines_removed += 1
+                continue
+            kept.append(line)
+        cleaned.append("\n".join(kept))
+    return cleaned
+
+
+def _dedup_paragraphs(text: str, report: PrepReport) -> str:
+    seen = set()
+    kept = []
+    for paragraph in text.split("\n\n"):
+        sig = _line_signature(paragraph)
+        # короткие абзацы (заголовки, «Статья 5.») повторяются законно
+        if len(sig) >= 40:
+            if sig in seen:
+                report.duplicate_paragraphs_removed += 1
+                continue
+            seen.add(sig)
+        kept.append(paragraph)
+    return "\n\n".join(kept)
+
+
+def fit_to_budget(text: str, token_budget: Optional[int] = None) -> tuple[str, bool]:
+    """Обрезает текст по границе абзаца, если он не влезает в бюджет токенов; возвращает (текст, обрезан ли)."""
+    if token_budget is None:
+        token_budget = DEFAULT_TOKEN_BUDGET
+    if not token_budget or estimate_tokens(text) <= token_budget:
+        return text, False
+    return _truncate_to_budget(text, token_budget), True
+
+
+def _truncate_to_budget(text: str, token_budget: int) -> str:
+    limit = int(token_budget * CHARS_PER_TOKEN)
+    cut = text[:limit]
+    # стараемся резать по границе абзаца или хотя бы предложения
+    for sep in ("\n\n", ". ", "\n"):
+        pos = cut.rfind(sep)
+        if pos > limit // 2:
+            return cut[:pos + len(sep)].rstrip()
+    return cut
+
+
+def preprocess_pages(pages: list[str], token_budget: Optional[int] = None) -> tuple[str, PrepReport]:
+    """
+    Нормализует постраничный текст PDF перед отправкой в LLM.
+
+    Убирает строки, повторяющиеся на краях многих страниц (колонтитулы, номера страниц),
+    склеивает переносы, схлопывает пробелы и пустые строки, удаляет повторные абзацы и,
+    если оценка токенов превышает бюджет, обрезает текст по границе абзаца.
+
+    Args:
+        pages: текст каждой страницы
+        token_budget: максимум токенов на выходе (по умолчанию COMIX_TOKEN_BUDGET); 0 — без ограничения
+
+    Returns:
+        (нормализованный текст, отчёт о том, сколько удалено)
+    """
+    raw = "".join(pages)
+    report = PrepReport(chars_before=len(raw), tokens_before=estimate_tokens(raw))
+
+    text = "\n".join(_strip_headers_footers(pages, report))
+    text, report.hyphenations_joined = _HYPHEN_RE.subn(r"\1\2", text)
+    text = "\n".join(_WS_RE.sub(" ", line).strip() for line in text.splitlines())
+    text = _BLANK_LINES_RE.sub("\n\n", text).strip()
+    text = _dedup_paragraphs(text, report)
+
+    text, report.truncated = fit_to_budget(text, token_budget)
+
+    report.chars_after = len(text)
+    report.tokens_after = estimate_tokens(text)
+    return text, report
+
+
+def preprocess_text(text: str, token_budget: Optional[int] = None) -> tuple[str, PrepReport]:
+    """То же для уже склеенного текста (без постраничной информации колонтитулы не ищутся)."""
+    return preprocess_pages([text], token_budget)
+
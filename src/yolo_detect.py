@@ -2,26 +2,142 @@ import cv2
 import numpy as np
 from ultralytics import YOLO
 import os
+import resource
+import threading
+import time
+
+_DEFAULT_WEIGHTS = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..', 'yolov8x6_animeface.pt')
+)
+
+
+class ModelRegistry:
+    """Процесс-глобальный реестр детекторов: веса грузятся один раз на процесс."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+        self._stats = {}
+
+    def get(self, weights_path: str = _DEFAULT_WEIGHTS):
+        model = self._models.get(weights_path)
+        if model is not None:
+            return model
+        with self._lock:
+            # Повторная проверка: другой поток мог загрузить модель, пока мы ждали блокировку
+            model = self._models.get(weights_path)
+            if model is None:
+                rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                started = time.perf_counter()
+                model = YOLO(weights_path)
+                load_seconds = time.perf_counter() - started
+                rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                self._stats[weights_path] = {
+                    'load_seconds': load_seconds,
+                    'param_bytes': _param_bytes(model),
+                    # ru_maxrss в Linux — килобайты
+                    'rss_delta_bytes': max(rss_after - rss_before, 0) * 1024,
+                    'warmed_up': False,
+                }
+                self._models[weights_path] = model
+        return model
+
+    def warmup(self, weights_path: str = _DEFAULT_WEIGHTS, imgsz: int = 640) -> None:
+        """Загружает модель и прогоняет пустой кадр, чтобы первый реальный запрос не платил за инициализацию."""
+        model = self.get(weights_path)
+        started = time.perf_counter()
+        with _inference_lock:
+            model(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), conf=0.5, verbose=False)
+        with self._lock:
+            self._stats[weights_path]['warmed_up'] = True
+            self._stats[weights_path]['warmup_seconds'] = time.perf_counter() - started
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {path: dict(s) for path, s in self._stats.items()}
+
+
+def _param_bytes(model) -> int:
+    try:
+        return sum(p.numel() * p.element_size() for p in model.model.parameters())
+    except Exception:
+        return 0
+
+
+registry = ModelRegistry()
+
+# Предикт ultralytics не потокобезопасен на одном экземпляре модели
+_inference_lock = threading.Lock()
+
+
+def get_model():
+    return registry.get()
+
+
+def warmup_model() -> None:
+    registry.warmup()
+
+
+def get_model_stats() -> dict:
+    return registry.stats()
+
+
+def _to_rgb(image):
+    """bytes (закодированная картинка) -> RGB ndarray; ndarray считается уже RGB."""
+    if isinstance(image, np.ndarray):
+        return image
+    nparr = np.frombuffer(image, np.uint8)
+    decoded = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    return cv2.cvtColor(decoded, cv2.COLOR_BGR2RGB)
+
+
+def _face_centers(result):
+    coords = []
+    boxes = result.boxes
+    if boxes is not None:
+        for box in boxes:
+            xyxy = box.xyxy[0].cpu().numpy()
+            x_center = (xyxy[0] + xyxy[2]) / 2
+            y_center = (xyxy[1] + xyxy[3]) / 2
+            coords.append((x_center, y_center))
+    return coords
+
 
 def detect_faces(image_bytes):
-    current_dir = os.path.dirname(__file__)
-    weights_path = os.path.abspath(os.path.join(current_dir, '..', 'yolov8x6_animeface.pt'))
-    model = YOLO(weights_path)
-
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    
-    results = model(image_rgb, conf=0.5)
+    model = get_model()
+    image_rgb = _to_rgb(image_bytes)
+
+    with _inference_lock:
+        results = model(image_rgb, conf=0.5)
     coords = []
-    
+
     for result in results:
-        boxes = result.boxes
-        if boxes is not None:
-            for box in boxes:
-                xyxy = box.xyxy[0].cpu().numpy()
-                x_center = (xyxy[0] + xyxy[2]) / 2
-                y_center = (xyxy[1] + xyxy[3]) / 2
-                coords.append((x_center, y_center))
-    
-    return coords
\ No newline at end of file
+        coords.extend(_face_centers(result))
+
+    return coords
+
+
+def detect_faces_batch(images, batch_size: int = 8):
+    """
+    Детекция лиц сразу на нескольких картинках: один батчевый прогон модели вместо N отдельных.
+
+    Args:
+        images: список bytes (PNG/JPEG) или RGB ndarray
+        batch_size: сколько кадров подавать в модель за один forward
+
+    Returns:
+        Список списков координат центров лиц, по одному на каждую входную картинку (в том же порядке).
+    """
+    if not images:
+        return []
+    model = get_model()
+    frames = [_to_rgb(img) for img in images]
+
+    coords = []
+    # Список ndarray ultralytics обрабатывает одним батчем, поэтому режем на куски вручную
+    for start in range(0, len(frames), batch_size):
+        with _inference_lock:
+            results = model(frames[start:start + batch_size], conf=0.5, verbose=False)
+        for result in results:
+            coords.append(_face_centers(result))
+    return coords